@@ -2,11 +2,12 @@ from django.contrib import admin
 from models import Account, Container
 
 class AccountAdmin(admin.ModelAdmin):
-    list_display = ('user', )
+    list_display = ('user', 'container_count', 'object_count', 'bytes_used')
 
 class ContainerAdmin(admin.ModelAdmin):
     fields = ('name', 'path', 'account')
-    list_display = ('name', 'path', 'account')
+    list_display = ('name', 'path', 'account', 'object_count', 'bytes_used',
+                    'storage_backend')
     list_filter = ('account',)
     search_fields = ('name', )
 
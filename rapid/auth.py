@@ -0,0 +1,114 @@
+"""
+Validation of the ``X-Auth-Token`` issued by the authentication view.
+
+Valid tokens are kept for ``AUTH_TOKEN_CACHE_TTL`` seconds in the Django
+cache named by ``AUTH_TOKEN_CACHE``, shared by processes, or otherwise in a
+per-process cache. No entry outlives the token's expiration, so
+authenticated requests only query the database once in a while.
+
+A replaced token is removed from the shared cache at once, so every process
+refuses it from then on. Processes without a shared cache can't hear of it,
+and accept it until their own entry runs out.
+"""
+import time
+import datetime
+import threading
+
+from django.core.cache import get_cache
+
+from models import Account
+import settings
+
+# token -> (account name, token expiration, cached until)
+_tokens = {}
+_tokens_lock = threading.Lock()
+_shared_caches = {}
+
+def _get_shared_cache():
+    """
+    Return the Django cache shared by processes, or ``None``. The cache is
+    made once for each value of the setting, as ``get_cache`` builds a new 
+    client each time.
+    """
+    if not settings.AUTH_TOKEN_CACHE:
+        return None
+    if settings.AUTH_TOKEN_CACHE not in _shared_caches:
+        _shared_caches[settings.AUTH_TOKEN_CACHE] = \
+            get_cache(settings.AUTH_TOKEN_CACHE)
+    return _shared_caches[settings.AUTH_TOKEN_CACHE]
+
+
+def _cache_key(token):
+    """The shared cache key of ``token``"""
+    return 'rapid.auth_token.%s' % token
+
+
+def _remember(token, account_name, expires, now):
+    """
+    Keep a valid token in the per-process cache, dropping expired entries
+    when the cache is full
+    """
+    cached_until = min(now + settings.AUTH_TOKEN_CACHE_TTL, expires)
+    _tokens_lock.acquire()
+    try:
+        if len(_tokens) >= settings.AUTH_TOKEN_CACHE_SIZE:
+            for key, entry in _tokens.items():
+                if entry[2] <= now:
+                    del _tokens[key]
+            if len(_tokens) >= settings.AUTH_TOKEN_CACHE_SIZE:
+                _tokens.clear()
+        _tokens[token] = (account_name, expires, cached_until)
+    finally:
+        _tokens_lock.release()
+
+
+def get_token_account_name(token):
+    """
+    Return the user name of the account ``token`` was issued to, or ``None``
+    if the token is unknown or has expired
+    """
+    if not token:
+        return None
+    now = time.time()
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        entry = _tokens.get(token)
+        if entry is not None and entry[2] > now:
+            return entry[0]
+    else:
+        # Not kept in the process as well, so that replacing a token 
+        # revokes it everywhere
+        entry = shared_cache.get(_cache_key(token))
+        if entry is not None and entry[1] > now:
+            return entry[0]
+    
+    try:
+        account = Account.objects.select_related('user').get(auth_token=token)
+    except Account.DoesNotExist:
+        return None
+    if account.token_expires <= datetime.datetime.now():
+        return None
+    account_name = account.user.username
+    expires = time.mktime(account.token_expires.timetuple())
+    if shared_cache is None:
+        _remember(token, account_name, expires, now)
+    else:
+        shared_cache.set(_cache_key(token), (account_name, expires),
+            max(int(min(settings.AUTH_TOKEN_CACHE_TTL, expires - now)), 1))
+    return account_name
+
+
+def forget_token(token):
+    """
+    Remove ``token`` from the caches, when it is replaced by a new token
+    """
+    if not token:
+        return
+    _tokens_lock.acquire()
+    try:
+        _tokens.pop(token, None)
+    finally:
+        _tokens_lock.release()
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.delete(_cache_key(token))
@@ -0,0 +1,140 @@
+"""
+Checksums of storage objects computed on a bounded pool of worker threads.
+
+Listings that find objects without a cached checksum hash them a page at a
+time on the pool instead of one after the other. hashlib releases the GIL
+while it hashes large buffers, so the files are read and hashed in parallel.
+"""
+import time
+import Queue
+import threading
+
+from fileutils import file_md5
+from instrumentation import instrumented
+import settings
+
+class ChecksumJob(object):
+    """
+    The checksum of one storage object, computed by a worker
+    """
+    def __init__(self, sobj, deadline=None):
+        self.sobj = sobj
+        self.deadline = deadline
+        self.checksum = None
+        self.done = threading.Event()
+    
+    def run(self):
+        """
+        Hash the object, unless the deadline has already passed
+        """
+        try:
+            try:
+                if self.deadline is None or time.time() < self.deadline:
+                    fileobj = self.sobj.open()
+                    try:
+                        self.checksum = file_md5(fileobj,
+                            settings.DOWNLOAD_CHUNK_SIZE, self.deadline)
+                    finally:
+                        fileobj.close()
+            except (IOError, OSError):
+                pass
+        finally:
+            self.done.set()
+    
+    def wait(self):
+        """
+        Return the checksum, or ``None`` if it wasn't computed by the deadline
+        """
+        timeout = None
+        if self.deadline is not None:
+            timeout = max(0, self.deadline - time.time())
+        self.done.wait(timeout)
+        if not self.done.isSet():
+            return None
+        return self.checksum
+
+
+class ChecksumPool(object):
+    """
+    A fixed number of daemon threads hashing the objects submitted to them,
+    started when the first job is submitted
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+    
+    def start(self):
+        """
+        Start the worker threads that aren't running yet
+        """
+        if len(self.threads) >= self.workers:
+            return
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work,
+                                          name='rapid-checksum')
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+    
+    def work(self):
+        """
+        Run jobs forever
+        """
+        while True:
+            self.jobs.get().run()
+    
+    def submit(self, sobj, deadline=None):
+        """
+        Queue the hashing of ``sobj`` and return its :class:`ChecksumJob`
+        """
+        self.start()
+        job = ChecksumJob(sobj, deadline)
+        self.jobs.put(job)
+        return job
+
+
+_pool = None
+
+def get_checksum_pool():
+    """
+    Return the process's pool of ``CHECKSUM_WORKERS`` threads
+    """
+    global _pool # pylint: disable-msg=W0603
+    if _pool is None:
+        _pool = ChecksumPool(settings.CHECKSUM_WORKERS)
+    return _pool
+
+
+@instrumented('hash')
+def compute_checksums(storage_objects, deadline=None):
+    """
+    Hash the ``storage_objects`` that have no cached checksum on the pool,
+    and record the checksums from the calling thread, which owns the
+    database connection.
+    
+    Objects that aren't hashed by the ``time.time()`` value ``deadline`` get
+    an empty checksum, which isn't recorded, so a later request tries again.
+    Nothing is done when ``CHECKSUM_WORKERS`` is 0; the objects are then
+    hashed one by one when their ``hash`` is requested.
+    """
+    if settings.CHECKSUM_WORKERS < 1:
+        return
+    pending = [sobj for sobj in storage_objects
+               if not sobj.isdir and not hasattr(sobj, '_hash')]
+    if not pending:
+        return
+    pool = get_checksum_pool()
+    jobs = [pool.submit(sobj, deadline) for sobj in pending]
+    for job in jobs:
+        checksum = job.wait()
+        if checksum is None:
+            job.sobj._hash = '' # pylint: disable-msg=W0212
+        else:
+            job.sobj.record_checksum(checksum)
+            job.sobj._hash = checksum # pylint: disable-msg=W0212
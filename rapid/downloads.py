@@ -0,0 +1,301 @@
+"""
+Download backends send the contents of a storage object to the client.
+
+The backend is chosen with the ``DOWNLOAD_BACKEND`` setting.
+"""
+import os
+import urllib
+import uuid
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.servers.basehttp import FileWrapper
+from django.http import HttpResponse
+from django.utils.http import http_date
+from django.utils.importlib import import_module
+
+import settings
+from http import (HttpResponsePartialContent, 
+                  HttpResponseRequestedRangeNotSatisfiable, parse_range_header,
+                  if_range_matches)
+
+def iter_file_range(fileobj, first, length, chunk_size):
+    """
+    Yield ``length`` bytes of ``fileobj`` starting at ``first``, at most 
+    ``chunk_size`` bytes at a time, and close the file when done.
+    """
+    try:
+        fileobj.seek(first)
+        while length > 0:
+            chunk = fileobj.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        fileobj.close()
+
+
+def set_object_headers(response, sobj, etag=None):
+    """
+    Set the ``ETag``, ``Last-Modified``, user metadata and, for large 
+    objects, ``X-Object-Manifest`` headers of ``sobj``
+    """
+    response['ETag'] = etag or sobj.hash
+    response['Last-Modified'] = http_date(sobj.modified)
+    if sobj.manifest:
+        response['X-Object-Manifest'] = sobj.manifest
+    for name, value in sobj.metadata.items():
+        response['X-Object-Meta-%s' % name] = value
+
+
+class FileWrapperBackend(object):
+    """
+    Stream the file through the Django response in chunks of 
+    ``DOWNLOAD_CHUNK_SIZE`` bytes. Works everywhere, but the data passes 
+    through the worker.
+    
+    ``Range`` requests are answered by seeking to the requested bytes, with 
+    a ``multipart/byteranges`` body when more than one range is requested.
+    """
+    def serve(self, request, sobj):
+        """
+        Return a response with the contents of ``sobj``, or the parts of it 
+        requested in the ``Range`` header. An ``If-Range`` header that doesn't 
+        match the object means the whole object is sent.
+        """
+        ranges = None
+        if 'HTTP_RANGE' in request.META and \
+                if_range_matches(request, sobj.hash, sobj.modified):
+            ranges = parse_range_header(request.META['HTTP_RANGE'], 
+                                        sobj.bytes)
+        if ranges is None:
+            response = self.serve_file(sobj)
+        elif not ranges:
+            response = HttpResponseRequestedRangeNotSatisfiable()
+            response['Content-Range'] = 'bytes */%d' % sobj.bytes
+        elif len(ranges) == 1:
+            response = self.serve_range(sobj, *ranges[0])
+        else:
+            response = self.serve_ranges(sobj, ranges)
+        self.set_headers(response, sobj)
+        return response
+    
+    def serve_file(self, sobj):
+        """
+        Return a response with the whole file
+        """
+        fileobj = sobj.open()
+        response = HttpResponse(
+            FileWrapper(fileobj, settings.DOWNLOAD_CHUNK_SIZE), 
+            content_type=sobj.content_type)
+        response['Content-Length'] = sobj.bytes
+        return response
+    
+    def serve_range(self, sobj, first, last):
+        """
+        Return a partial response with bytes ``first`` to ``last`` of the file
+        """
+        return self.partial_response(sobj, first, last, 
+            iter_file_range(sobj.open(), first, last - first + 1, 
+                            settings.DOWNLOAD_CHUNK_SIZE))
+    
+    def partial_response(self, sobj, first, last, body):
+        """
+        Return a partial response sending bytes ``first`` to ``last`` of the 
+        file with the iterable ``body``
+        """
+        response = HttpResponsePartialContent(body, 
+                                              content_type=sobj.content_type)
+        response['Content-Length'] = last - first + 1
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, 
+                                                        sobj.bytes)
+        return response
+    
+    def serve_ranges(self, sobj, ranges):
+        """
+        Return a ``multipart/byteranges`` response with each of ``ranges``
+        """
+        boundary = uuid.uuid4().hex
+        parts = []
+        for first, last in ranges:
+            part_header = '\r\n'.join([
+                '--%s' % boundary,
+                'Content-Type: %s' % sobj.content_type,
+                'Content-Range: bytes %d-%d/%d' % (first, last, sobj.bytes),
+                '', ''])
+            parts.append((part_header, first, last - first + 1))
+        closing = '\r\n--%s--\r\n' % boundary
+        
+        def body():
+            """Yield each part header followed by its bytes"""
+            fileobj = sobj.open()
+            try:
+                separator = ''
+                for part_header, first, length in parts:
+                    yield separator + part_header
+                    fileobj.seek(first)
+                    while length > 0:
+                        chunk = fileobj.read(
+                            min(settings.DOWNLOAD_CHUNK_SIZE, length))
+                        if not chunk:
+                            break
+                        length -= len(chunk)
+                        yield chunk
+                    separator = '\r\n'
+                yield closing
+            finally:
+                fileobj.close()
+        
+        response = HttpResponsePartialContent(body(), 
+            content_type='multipart/byteranges; boundary=%s' % boundary)
+        response['Content-Length'] = (
+            sum(len(part_header) + length for part_header, _, length in parts)
+            + 2 * (len(parts) - 1) + len(closing))
+        return response
+    
+    def set_headers(self, response, sobj):
+        """
+        Set the headers describing ``sobj``
+        """
+        set_object_headers(response, sobj)
+        response['Accept-Ranges'] = 'bytes'
+
+
+class WSGIFileWrapperBackend(FileWrapperBackend):
+    """
+    Hand the open file to the server's ``wsgi.file_wrapper``, which servers 
+    such as mod_wsgi and gunicorn send with ``sendfile(2)``, so the data never 
+    passes through Python.
+    
+    Requires the Django WSGI handler to be wrapped with 
+    :class:`rapid.wsgi.FileWrapperMiddleware`; otherwise it behaves like 
+    :class:`FileWrapperBackend`. Ranges that run to the end of the file are 
+    sent from the seeked file the same way; other ranges are streamed.
+    """
+    def serve_file(self, sobj):
+        """
+        Return a response that carries the open file for the WSGI server
+        """
+        response = super(WSGIFileWrapperBackend, self).serve_file(sobj)
+        response.file_to_stream = response._container.filelike # pylint: disable-msg=W0212
+        return response
+    
+    def serve_range(self, sobj, first, last):
+        """
+        Return a partial response, carrying the seeked file for the WSGI 
+        server when the range runs to the end of the file
+        """
+        if last != sobj.bytes - 1:
+            return super(WSGIFileWrapperBackend, self).serve_range(
+                sobj, first, last)
+        fileobj = sobj.open()
+        fileobj.seek(first)
+        response = self.partial_response(sobj, first, last, 
+            FileWrapper(fileobj, settings.DOWNLOAD_CHUNK_SIZE))
+        response.file_to_stream = fileobj
+        return response
+
+
+class XSendfileBackend(FileWrapperBackend):
+    """
+    Let the web server send the file by setting the ``X-Sendfile`` header,
+    as supported by Apache's mod_xsendfile and lighttpd.
+    """
+    header = 'X-Sendfile'
+    
+    def file_location(self, sobj):
+        """
+        The value of the header for ``sobj``, or ``None`` if the web server
+        can't serve it. The path is absolute, as the web server doesn't share
+        the working directory of Django.
+        """
+        path = sobj.local_path
+        if path is None:
+            return None
+        return os.path.abspath(path)
+    
+    def serve(self, request, sobj):
+        """
+        Return an empty response pointing the web server at the file. The 
+        web server answers ``Range`` requests itself.
+        """
+        location = self.file_location(sobj)
+        if location is None:
+            return super(XSendfileBackend, self).serve(request, sobj)
+        response = HttpResponse(content_type=sobj.content_type)
+        response[self.header] = location
+        self.set_headers(response, sobj)
+        return response
+
+
+class XAccelRedirectBackend(XSendfileBackend):
+    """
+    Let nginx send the file by setting the ``X-Accel-Redirect`` header.
+    
+    Files under ``CONTAINER_LOCATION`` are redirected to the same relative
+    path under the ``X_ACCEL_REDIRECT_PREFIX`` internal location. Containers
+    stored elsewhere are streamed by Django.
+    """
+    header = 'X-Accel-Redirect'
+    
+    def file_location(self, sobj):
+        """
+        The internal nginx URL of ``sobj``
+        """
+        if sobj.local_path is None:
+            return None
+        root = os.path.abspath(settings.CONTAINER_LOCATION) + os.sep
+        path = os.path.abspath(sobj.local_path)
+        if not path.startswith(root):
+            return None
+        relpath = path[len(root):].replace(os.sep, '/')
+        return settings.X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + \
+            urllib.quote(relpath)
+
+
+def manifest_etag(segments):
+    """
+    The ``ETag`` of a large object: the md5 of its segments' checksums
+    """
+    return md5(''.join(segment.hash for segment in segments)).hexdigest()
+
+
+def serve_segments(sobj, segments):
+    """
+    Return a response with the ``segments`` of the large object ``sobj`` 
+    streamed one after the other
+    """
+    def body():
+        """Yield the data of each segment in turn"""
+        for segment in segments:
+            for chunk in iter_file_range(segment.open(), 0, 
+                    segment.bytes, settings.DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+    
+    response = HttpResponse(body(), content_type=sobj.content_type)
+    response['Content-Length'] = sum(segment.bytes for segment in segments)
+    return response
+
+
+_backend = None
+
+def get_download_backend():
+    """
+    Return an instance of the configured ``DOWNLOAD_BACKEND``
+    """
+    global _backend # pylint: disable-msg=W0603
+    if _backend is None:
+        module_name, _, class_name = settings.DOWNLOAD_BACKEND.rpartition('.')
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError, ValueError), err:
+            raise ImproperlyConfigured(
+                'Error loading download backend %s: "%s"' % (
+                    settings.DOWNLOAD_BACKEND, err))
+        _backend = backend_class()
+    return _backend
@@ -0,0 +1,239 @@
+"""
+File system helpers for storing objects
+"""
+import os
+import time
+import errno
+from stat import S_ISDIR
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# The Linux ioctl that makes a file share the data blocks of another file
+FICLONE = 0x40049409
+
+def reflink(src_path, dst_path):
+    """
+    Create ``dst_path`` as a copy-on-write clone of ``src_path``. Returns
+    ``False`` when the file system (or platform) can't clone files.
+    """
+    if fcntl is None:
+        return False
+    src = open(src_path, 'rb')
+    try:
+        dst = open(dst_path, 'wb')
+        try:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return True
+            except (IOError, OSError):
+                pass
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.remove(dst_path)
+    return False
+
+
+def copy_file(src_path, dst_path, use_hardlinks=False, chunk_size=64 * 1024):
+    """
+    Copy ``src_path`` to the new file ``dst_path`` without reading it into
+    memory.
+    
+    A hard link is tried first when ``use_hardlinks`` is set, then a reflink,
+    and finally the data is copied ``chunk_size`` bytes at a time. The md5
+    checksum is returned when the data had to be read, otherwise ``None``.
+    """
+    if use_hardlinks:
+        try:
+            os.link(src_path, dst_path)
+            return None
+        except OSError, err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                 errno.ENOTSUP):
+                raise
+    if reflink(src_path, dst_path):
+        return None
+    
+    checksum = md5()
+    src = open(src_path, 'rb')
+    try:
+        dst = open(dst_path, 'wb')
+        try:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                dst.write(chunk)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    return checksum.hexdigest()
+
+
+def blob_path(root, digest):
+    """
+    The path of the blob with the content hash ``digest`` in the blob store
+    at ``root``
+    """
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+
+def link_blob(root, temp_path, digest):
+    """
+    Make ``temp_path`` a hard link to the blob with the content hash 
+    ``digest``. If the store has no such blob yet, ``temp_path`` becomes it; 
+    otherwise ``temp_path`` is replaced by a link to the existing blob and 
+    its data is dropped.
+    
+    The number of links to a blob, less the store's own, is the number of 
+    objects referring to it. Returns ``False`` if the blob store can't be 
+    linked to, for example because it is on another file system.
+    """
+    path = blob_path(root, digest)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, err:
+            if err.errno != errno.EEXIST:
+                raise
+    link_path = temp_path + '.blob'
+    while True:
+        try:
+            os.link(temp_path, path)
+            return True
+        except OSError, err:
+            if err.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                return False
+            if err.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(path, link_path)
+        except OSError, err:
+            # The blob was released in the meantime; store ours instead
+            if err.errno == errno.ENOENT:
+                continue
+            raise
+        os.rename(link_path, temp_path)
+        return True
+
+
+def release_blob(root, digest):
+    """
+    Remove the blob with the content hash ``digest`` once no object refers
+    to it
+    """
+    path = blob_path(root, digest)
+    try:
+        if os.stat(path).st_nlink <= 1:
+            os.remove(path)
+    except OSError, err:
+        if err.errno != errno.ENOENT:
+            raise
+
+
+def fsync_directory(path):
+    """
+    Flush the entries of the directory ``path`` to disk, so files renamed
+    into it survive a crash
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        try:
+            os.fsync(fd)
+        except OSError, err:
+            # Some file systems can't sync directories
+            if err.errno not in (errno.EINVAL, errno.EBADF):
+                raise
+    finally:
+        os.close(fd)
+
+
+def file_md5(fileobj, chunk_size=64 * 1024, deadline=None):
+    """
+    Return the md5 checksum of the rest of ``fileobj``. Reading stops, and 
+    ``None`` is returned, once the ``time.time()`` value ``deadline`` has 
+    passed.
+    
+    Large chunks let other threads run while the data is hashed.
+    """
+    checksum = md5()
+    while True:
+        if deadline is not None and time.time() >= deadline:
+            return None
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class ListedEntry(object):
+    """
+    A stand-in for the entries of :func:`os.scandir` where neither it nor 
+    the ``scandir`` package is available. The file is stat'ed once, when 
+    first asked about.
+    """
+    __slots__ = ('name', 'path', '_stat')
+    
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        self._stat = None
+    
+    def stat(self):
+        """
+        The :func:`os.stat` of the file
+        """
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+    
+    def is_dir(self):
+        """
+        Is the file a directory?
+        """
+        try:
+            return S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+def scan_directory(path):
+    """
+    Return the entries of the directory ``path``, sorted by name. Each has 
+    the ``name`` and ``path`` of a file, and ``is_dir()`` and ``stat()`` 
+    methods that cache what they learn.
+    
+    With :func:`os.scandir`, or the ``scandir`` package on Python 2, the 
+    type of most files comes with the directory listing, so telling files 
+    from directories costs no system call, and ``stat()`` one per file.
+    """
+    if scandir is not None:
+        entries = list(scandir(path))
+    else:
+        entries = [ListedEntry(path, name) for name in os.listdir(path)]
+    entries.sort(key=lambda entry: entry.name)
+    return entries
+
@@ -1,4 +1,5 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_http_date_safe
 
 class HttpResponseCreated(HttpResponse):
     status_code = 201
@@ -9,8 +10,183 @@ class HttpResponseAccepted(HttpResponse):
 class HttpResponseNoContent(HttpResponse):
     status_code = 204
 
+class HttpResponsePartialContent(HttpResponse):
+    status_code = 206
+
 class HttpResponseUnauthorized(HttpResponse):
     status_code = 401
 
 class HttpResponseConflict(HttpResponse):
     status_code = 409
+
+class HttpResponsePreconditionFailed(HttpResponse):
+    status_code = 412
+
+class HttpResponseRequestedRangeNotSatisfiable(HttpResponse):
+    status_code = 416
+
+class HttpResponseServiceUnavailable(HttpResponse):
+    status_code = 503
+
+
+class RequestBodyTruncated(IOError):
+    """
+    The request body ended before the ``Content-Length`` it announced
+    """
+
+def iter_request_body(request, chunk_size):
+    """
+    Yield the body of ``request`` in chunks of at most ``chunk_size`` bytes, 
+    so the whole body never has to be held in memory.
+    
+    Bodies with a ``Content-Length`` are read up to that length, and raise 
+    :exc:`RequestBodyTruncated` if the client stops sending before the end. 
+    Bodies sent with ``Transfer-Encoding: chunked`` are read from 
+    ``wsgi.input`` until it is exhausted, which relies on the server 
+    de-chunking the request.
+    """
+    if request.META.get('HTTP_TRANSFER_ENCODING', '').lower() == 'chunked':
+        stream = request.environ['wsgi.input']
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        return
+    
+    try:
+        remaining = int(request.META.get('CONTENT_LENGTH') or 0)
+    except (ValueError, TypeError):
+        remaining = 0
+    while remaining > 0:
+        chunk = request.read(min(chunk_size, remaining))
+        if not chunk:
+            raise RequestBodyTruncated('The request body is %d bytes short' % 
+                                       remaining)
+        remaining -= len(chunk)
+        yield chunk
+
+
+# The most bytes of user metadata, names and values, an object can have
+MAX_METADATA_SIZE = 4096
+
+def parse_object_metadata(request):
+    """
+    Return the ``X-Object-Meta-*`` headers of ``request`` as a dictionary of 
+    the header names, without the prefix, to their values, or ``None`` if 
+    they add up to more than ``MAX_METADATA_SIZE`` bytes
+    """
+    metadata = {}
+    for key, value in request.META.items():
+        if key.startswith('HTTP_X_OBJECT_META_') and len(key) > 19:
+            name = '-'.join(part.capitalize() 
+                            for part in key[19:].split('_'))
+            metadata[name] = value
+    if sum(len(name) + len(value) for name, value in metadata.items()) > \
+            MAX_METADATA_SIZE:
+        return None
+    return metadata
+
+
+def parse_range_header(header, size):
+    """
+    Parse a ``Range: bytes=...`` header for a body of ``size`` bytes.
+    
+    Returns ``None`` when there is no header or it can't be parsed, in which 
+    case the whole body should be sent. Otherwise returns a list of 
+    ``(first, last)`` byte positions, which is empty when none of the 
+    requested ranges can be satisfied.
+    """
+    if not header:
+        return None
+    units, _, byte_ranges = header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for byte_range in byte_ranges.split(','):
+        first, sep, last = byte_range.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not first:
+                suffix_length = int(last)
+                if suffix_length > 0 and size > 0:
+                    ranges.append((max(size - suffix_length, 0), size - 1))
+                continue
+            first = int(first)
+            if last:
+                last = int(last)
+                if last < first:
+                    return None
+            else:
+                last = size - 1
+        except ValueError:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+    return ranges
+
+
+def parse_etags(header):
+    """
+    Return the list of entity tags in an ``If-Match`` or ``If-None-Match`` 
+    header, without quotes or weakness indicators
+    """
+    etags = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etags.append(etag.strip('"'))
+    return etags
+
+
+def check_preconditions(request, etag, mtime):
+    """
+    Evaluate the conditional headers of ``request`` against a resource with 
+    the entity tag ``etag`` that was last modified at ``mtime`` (seconds since 
+    the epoch).
+    
+    Returns a 412 (Precondition Failed) or 304 (Not Modified) response when 
+    the request should not be carried out, otherwise ``None``.
+    """
+    mtime = int(mtime)
+    if_match = request.META.get('HTTP_IF_MATCH')
+    if if_match:
+        etags = parse_etags(if_match)
+        if '*' not in etags and etag not in etags:
+            return HttpResponsePreconditionFailed()
+    else:
+        since = parse_http_date_safe(
+            request.META.get('HTTP_IF_UNMODIFIED_SINCE', ''))
+        if since is not None and mtime > since:
+            return HttpResponsePreconditionFailed()
+    
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        if '*' in etags or etag in etags:
+            if request.method in ('GET', 'HEAD'):
+                return HttpResponseNotModified()
+            return HttpResponsePreconditionFailed()
+    elif request.method in ('GET', 'HEAD'):
+        since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if since is not None and mtime <= since:
+            return HttpResponseNotModified()
+    return None
+
+
+def if_range_matches(request, etag, mtime):
+    """
+    Should the ``Range`` header of ``request`` be honoured? That is the case 
+    unless an ``If-Range`` header names another entity tag or date than that 
+    of the resource.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    since = parse_http_date_safe(if_range)
+    if since is not None:
+        return int(mtime) == since
+    return parse_etags(if_range) == [etag]
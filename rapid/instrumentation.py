@@ -0,0 +1,282 @@
+"""
+Per-request timings of the work behind the API views.
+
+Add ``rapid.instrumentation.InstrumentationMiddleware`` to the
+``MIDDLEWARE_CLASSES`` setting to record, for each request, the time spent
+in database queries, storage backend stats and directory walks, checksum
+computation and listing serialization, and the bytes sent. Each time is
+measured exclusive of the others, so nested work isn't counted twice.
+
+With ``DEBUG``, each response gets a ``Server-Timing`` header with the
+times known when the view returns. Totals per view and HTTP method are
+logged to the ``rapid.instrumentation`` logger every
+``INSTRUMENTATION_LOG_INTERVAL`` seconds.
+"""
+import time
+import logging
+import threading
+from functools import wraps
+
+from django.conf import settings as django_settings
+from django.db import connection
+from django.db.backends.util import CursorWrapper, CursorDebugWrapper
+
+import settings
+
+logger = logging.getLogger('rapid.instrumentation')
+
+_local = threading.local()
+
+class RequestStats(object):
+    """
+    The timings and counters of one request
+    """
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.times = {}
+        self.calls = {}
+        self.bytes_sent = 0
+        # [category, started, time spent in nested timers]
+        self.stack = []
+    
+    def push(self, category):
+        """
+        Start timing ``category``
+        """
+        self.stack.append([category, time.time(), 0.0])
+    
+    def pop(self, count=True):
+        """
+        Stop the innermost timer, and add its time, less the time of the
+        timers nested in it, to its category
+        """
+        category, started, nested = self.stack.pop()
+        elapsed = time.time() - started
+        self.times[category] = self.times.get(category, 0.0) + elapsed - nested
+        if count:
+            self.calls[category] = self.calls.get(category, 0) + 1
+        if self.stack:
+            self.stack[-1][2] += elapsed
+    
+    def server_timing(self):
+        """
+        The value of a ``Server-Timing`` header with the times so far
+        """
+        return ', '.join('%s;dur=%.3f;desc="%d calls"' % (
+            category, self.times[category] * 1000, self.calls.get(category, 0))
+            for category in sorted(self.times))
+
+
+def current_stats():
+    """
+    The :class:`RequestStats` of the request the thread is handling, or
+    ``None`` when requests aren't instrumented
+    """
+    return getattr(_local, 'stats', None)
+
+
+def instrumented(category):
+    """
+    Decorate a function so its calls are timed under ``category``
+    """
+    def decorator(func):
+        """Wrap ``func``"""
+        def wrapper(*args, **kwargs):
+            """Time the call when the request is instrumented"""
+            stats = current_stats()
+            if stats is None:
+                return func(*args, **kwargs)
+            stats.push(category)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.pop()
+        return wraps(func)(wrapper)
+    return decorator
+
+
+def instrumented_iter(category):
+    """
+    Decorate a generator function so the time spent producing each of its
+    items is timed under ``category``
+    """
+    def decorator(func):
+        """Wrap ``func``"""
+        def wrapper(*args, **kwargs):
+            """Time each step of the iteration"""
+            iterator = iter(func(*args, **kwargs))
+            first = True
+            while True:
+                stats = current_stats()
+                if stats is not None:
+                    stats.push(category)
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+                finally:
+                    # Also when the generator raises, so the timer stack 
+                    # stays balanced
+                    if stats is not None:
+                        stats.pop(first)
+                first = False
+                yield item
+        return wraps(func)(wrapper)
+    return decorator
+
+
+class InstrumentedCursorWrapper(CursorWrapper):
+    """
+    A database cursor that times its queries
+    """
+    def execute(self, sql, params=()):
+        """Run a timed query"""
+        stats = current_stats()
+        if stats is None:
+            return self.cursor.execute(sql, params)
+        stats.push('db')
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            stats.pop()
+    
+    def executemany(self, sql, param_list):
+        """Run a timed query for each of ``param_list``"""
+        stats = current_stats()
+        if stats is None:
+            return self.cursor.executemany(sql, param_list)
+        stats.push('db')
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            stats.pop()
+
+
+def make_instrumented_cursor(cursor):
+    """
+    Wrap a new cursor of the connection, keeping the query log of ``DEBUG``
+    """
+    if django_settings.DEBUG:
+        cursor = CursorDebugWrapper(cursor, connection)
+    return InstrumentedCursorWrapper(cursor, connection)
+
+
+class StatsAggregator(object):
+    """
+    Totals of the requests of a process per view and HTTP method, logged
+    and reset at regular intervals
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.last_logged = time.time()
+    
+    def add(self, stats, elapsed):
+        """
+        Add a finished request, and log the totals if it's time to
+        """
+        self.lock.acquire()
+        try:
+            totals = self.totals.setdefault(stats.label,
+                {'requests': 0, 'time': 0.0, 'bytes': 0, 'times': {}})
+            totals['requests'] += 1
+            totals['time'] += elapsed
+            totals['bytes'] += stats.bytes_sent
+            for category, seconds in stats.times.items():
+                totals['times'][category] = \
+                    totals['times'].get(category, 0.0) + seconds
+            interval = settings.INSTRUMENTATION_LOG_INTERVAL
+            if interval is None or time.time() - self.last_logged < interval:
+                return
+            totals, self.totals = self.totals, {}
+            self.last_logged = time.time()
+        finally:
+            self.lock.release()
+        for label in sorted(totals):
+            self.log(label, totals[label])
+    
+    def log(self, label, totals):
+        """
+        Log one line with the totals of the view and method ``label``
+        """
+        logger.info('%s requests=%d time=%.1fms bytes=%d %s' % (
+            label, totals['requests'], totals['time'] * 1000, totals['bytes'],
+            ' '.join('%s=%.1fms' % (category, seconds * 1000)
+                     for category, seconds in sorted(totals['times'].items()))))
+
+aggregator = StatsAggregator()
+
+
+class InstrumentationMiddleware(object):
+    """
+    Record the :class:`RequestStats` of each request
+    """
+    def process_request(self, request):
+        """
+        Start the stats of the request and time its database queries
+        """
+        stats = current_stats()
+        if stats is not None:
+            # The body of the previous response was never sent
+            finish(stats)
+        _local.stats = RequestStats(request.method)
+        connection.use_debug_cursor = True
+        connection.make_debug_cursor = make_instrumented_cursor
+    
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        Label the stats with the view and method
+        """
+        stats = current_stats()
+        if stats is not None:
+            stats.label = '%s.%s' % (view_func.__name__, request.method)
+    
+    def process_response(self, request, response):
+        """
+        Add the debug header, and finish the stats once the body is sent
+        """
+        stats = current_stats()
+        if stats is None:
+            return response
+        if django_settings.DEBUG:
+            response['Server-Timing'] = stats.server_timing()
+        if getattr(response, 'file_to_stream', None) is not None:
+            # Sent by the WSGI server, see rapid.wsgi.FileWrapperMiddleware
+            stats.bytes_sent = int(response.get('Content-Length', 0))
+            finish(stats)
+        elif response._is_string: # pylint: disable-msg=W0212
+            stats.bytes_sent = len(response.content)
+            finish(stats)
+        else:
+            response._container = count_bytes( # pylint: disable-msg=W0212
+                response._container, stats) # pylint: disable-msg=W0212
+        return response
+
+
+def count_bytes(content, stats):
+    """
+    Yield the chunks of a streamed response body, counting them in
+    ``stats``, and finish the stats when the body has been sent
+    """
+    _local.stats = stats
+    try:
+        for chunk in content:
+            stats.bytes_sent += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(content, 'close'):
+            content.close()
+        finish(stats)
+
+
+def finish(stats):
+    """
+    Stop instrumenting the request and add its stats to the totals
+    """
+    if getattr(_local, 'stats', None) is stats:
+        del _local.stats
+        connection.use_debug_cursor = None
+        if 'make_debug_cursor' in connection.__dict__:
+            del connection.make_debug_cursor
+    aggregator.add(stats, time.time() - stats.started)
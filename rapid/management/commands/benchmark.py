@@ -0,0 +1,220 @@
+"""
+Measure the hot paths of the API against synthetic containers
+"""
+import os
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+from optparse import make_option
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+
+from rapid.models import Account, Container
+from rapid.storage import get_storage_backend
+from rapid import settings
+
+SMALL_SIZE = 1024
+
+class Command(BaseCommand):
+    """
+    Build containers of generated objects, time listing, container ``HEAD``,
+    object ``GET`` and object ``PUT`` through the Django test client, and
+    write one JSON result per line
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--objects', default='1000',
+            help='Comma separated numbers of objects per container, for '
+                 'example 1000,100000,1000000. Default: 1000'),
+        make_option('--layouts', default='flat,deep',
+            help='Comma separated name layouts: "flat" names, or "deep" '
+                 'names three directories down. Default: flat,deep'),
+        make_option('--huge-size', type='int', default=16 * 1024 * 1024,
+            help='The size in bytes of the huge objects read and written. '
+                 'Default: 16 MiB'),
+        make_option('--repeat', type='int', default=5,
+            help='How many times each operation is timed. Default: 5'),
+        make_option('--backend', default=None,
+            help='The storage backend class of the containers. Default: '
+                 'STORAGE_BACKEND'),
+        make_option('--root', default=None,
+            help='The directory to create the containers in. Default: a new '
+                 'temporary directory, removed afterwards'),
+        make_option('--output', default=None,
+            help='The file to write the results to. Default: standard output'),
+    )
+    help = ('Time the listing, HEAD, GET and PUT paths against generated '
+            'containers. Uses the configured database; the benchmark account '
+            'and its containers are deleted afterwards.')
+    
+    def handle(self, *args, **options):
+        """Run every benchmark and clean up"""
+        try:
+            counts = [int(count) for count in options['objects'].split(',')]
+        except ValueError:
+            raise CommandError('--objects must be a list of numbers')
+        layouts = options['layouts'].split(',')
+        for layout in layouts:
+            if layout not in ('flat', 'deep'):
+                raise CommandError('Unknown layout "%s"' % layout)
+        self.repeat = options['repeat']
+        self.backend_path = options['backend'] or settings.STORAGE_BACKEND
+        self.output = self.stdout
+        if options['output']:
+            self.output = open(options['output'], 'a')
+        
+        root = options['root']
+        remove_root = root is None
+        if remove_root:
+            root = tempfile.mkdtemp(prefix='rapid-benchmark-')
+        self.root = root
+        self.account = self.create_account()
+        try:
+            for count in counts:
+                for layout in layouts:
+                    self.bench_container(count, layout)
+            self.bench_objects('small', SMALL_SIZE)
+            self.bench_objects('huge', options['huge_size'])
+        finally:
+            user = self.account.user
+            for container in self.account.container_set.all():
+                shutil.rmtree(container.path, ignore_errors=True)
+                get_storage_backend(container.storage_backend).create_container(
+                    container.path)
+                container.delete()
+            self.account.delete()
+            user.delete()
+            if remove_root:
+                shutil.rmtree(root, ignore_errors=True)
+            if self.output is not self.stdout:
+                self.output.close()
+    
+    def create_account(self):
+        """
+        Create the benchmark account with a token, and a test client using it
+        """
+        username = 'rapid-benchmark-%d' % os.getpid()
+        user = User.objects.create(username=username)
+        account = Account.objects.create(user=user,
+            auth_token='benchmark-%d' % os.getpid(),
+            token_expires=datetime.datetime.now() + datetime.timedelta(days=1))
+        self.client = Client(HTTP_X_AUTH_TOKEN=account.auth_token)
+        return account
+    
+    def create_container(self, name):
+        """
+        Create an empty container for the benchmark
+        """
+        path = os.path.join(self.root, name)
+        backend = get_storage_backend(self.backend_path)
+        backend.create_container(path)
+        return Container.objects.create(name=name, path=path,
+            account=self.account, storage_backend=self.backend_path)
+    
+    def object_name(self, layout, number):
+        """
+        The name of the generated object ``number``
+        """
+        if layout == 'flat':
+            return 'object%07d' % number
+        return 'd%03d/d%03d/d%03d/object%07d' % (
+            number / 100000 % 1000, number / 1000 % 100, number / 10 % 100,
+            number)
+    
+    def bench_container(self, count, layout):
+        """
+        Fill a container with ``count`` small objects and time listing it
+        from the name index and from the storage backend, and ``HEAD``
+        """
+        container = self.create_container('%s-%d' % (layout, count))
+        data = 'x' * SMALL_SIZE
+        started = time.time()
+        for number in range(count):
+            container.backend.write(container.path,
+                                    self.object_name(layout, number), [data])
+        container.reconcile()
+        params = {'objects': count, 'layout': layout}
+        self.report('setup', params, [time.time() - started])
+        
+        self.report('storage_objects.indexed', params, self.measure(
+            lambda: container.storage_objects(limit=1000)))
+        container.indexed = False
+        self.report('storage_objects.backend', params, self.measure(
+            lambda: container.storage_objects(limit=1000)))
+        container.indexed = True
+        
+        url = reverse('container_services',
+                      args=[self.account.user.username, container.name])
+        self.report('ContainerView.head', params, self.measure(
+            lambda: self.request('head', url)))
+        self.report('ContainerView.get.json', params, self.measure(
+            lambda: self.request('get', url, {'format': 'json',
+                                              'limit': 1000})))
+    
+    def bench_objects(self, label, size):
+        """
+        Time ``PUT`` and ``GET`` of an object of ``size`` bytes
+        """
+        container = self.create_container('objects-%s' % label)
+        url = reverse('object_services', args=[self.account.user.username,
+            container.name, 'object-%s' % label])
+        data = 'x' * size
+        params = {'size': size}
+        self.report('ObjectView.put', params, self.measure(
+            lambda: self.request('put', url, data,
+                                 content_type='application/octet-stream')))
+        self.report('ObjectView.get', params, self.measure(
+            lambda: self.request('get', url)))
+    
+    def request(self, method, url, *args, **kwargs):
+        """
+        Make a request with the test client and read the whole response
+        """
+        response = getattr(self.client, method)(url, *args, **kwargs)
+        if response.status_code >= 300:
+            raise CommandError('%s %s returned %s' % (
+                method.upper(), url, response.status_code))
+        for chunk in response:
+            pass
+        response.close()
+    
+    def measure(self, func):
+        """
+        Return the durations of ``repeat`` calls of ``func``
+        """
+        durations = []
+        for attempt in range(self.repeat):
+            started = time.time()
+            func()
+            durations.append(time.time() - started)
+        return durations
+    
+    def report(self, benchmark, params, durations):
+        """
+        Write the result of a benchmark as a line of JSON
+        """
+        durations = sorted(durations)
+        median = durations[len(durations) / 2]
+        result = {
+            'benchmark': benchmark,
+            'backend': self.backend_path,
+            'runs': len(durations),
+            'min': round(durations[0], 6),
+            'median': round(median, 6),
+            'mean': round(sum(durations) / len(durations), 6),
+            'max': round(durations[-1], 6),
+            'ops_per_sec': median and round(1 / median, 2) or None,
+            'python': sys.version.split()[0],
+        }
+        result.update(params)
+        self.output.write(json.dumps(result, sort_keys=True) + '\n')
+        self.output.flush()
@@ -0,0 +1,34 @@
+"""
+Remove the blobs of the deduplicating store that no object is linked to
+"""
+import os
+
+from django.core.management.base import BaseCommand
+
+from rapid import settings
+
+class Command(BaseCommand):
+    """
+    Walk ``BLOB_LOCATION`` and remove the blobs with no other link
+    """
+    help = ('Remove the blobs of deduplicated objects that are no longer '
+            'linked to any object.')
+    
+    def handle(self, *args, **options):
+        """Remove the unreferenced blobs"""
+        verbosity = int(options.get('verbosity', 1))
+        removed = removed_bytes = 0
+        for dirpath, dirnames, filenames in os.walk(settings.BLOB_LOCATION):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                stat_info = os.stat(path)
+                if stat_info.st_nlink > 1:
+                    continue
+                os.remove(path)
+                removed += 1
+                removed_bytes += stat_info.st_size
+                if verbosity > 1:
+                    self.stdout.write('Removed %s\n' % name)
+        if verbosity:
+            self.stdout.write('%s blobs removed, %s bytes freed\n' % (
+                removed, removed_bytes))
@@ -0,0 +1,144 @@
+"""
+Move the objects of containers to another storage backend, for example from
+the plain file layout to the sharded one
+"""
+import os
+import time
+import uuid
+import shutil
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rapid.fileutils import copy_file
+from rapid.models import Container
+from rapid.storage import get_storage_backend
+from rapid import settings
+
+# Seconds for the writes that checked a container just before it was made
+# read only to create their temporary files
+SETTLE_TIME = 1
+
+class Command(BaseCommand):
+    """
+    Copy each container into a new directory with the new backend, swap the
+    directories and rebuild the name index
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--wait', type='int', default=60,
+            help='How many seconds to wait for the uploads in progress to '
+                 'finish before giving up on a container. Default: 60'),
+    )
+    args = '<backend> [<account>/<container> ...]'
+    help = ('Move the objects of the given containers, or of every container, '
+            'to the storage backend class <backend>, such as '
+            'rapid.storage.ShardedBackend. Writes to a container are refused '
+            'while it is moved.')
+    
+    def handle(self, *args, **options):
+        """Migrate the requested containers"""
+        if not args:
+            raise CommandError('Name the storage backend to migrate to')
+        backend_path = args[0]
+        new_backend = get_storage_backend(backend_path)
+        containers = Container.objects.select_related('account__user')
+        if args[1:]:
+            selected = []
+            for arg in args[1:]:
+                try:
+                    account_name, container_name = arg.split('/', 1)
+                    selected.append(containers.get(
+                        account__user__username=account_name,
+                        name=container_name))
+                except (ValueError, Container.DoesNotExist):
+                    raise CommandError('Unknown container "%s"' % arg)
+            containers = selected
+        
+        verbosity = int(options.get('verbosity', 1))
+        for container in containers:
+            if container.backend is new_backend:
+                continue
+            if container.backend.local_path(container.path, 'x') is None or \
+                    new_backend.local_path(container.path, 'x') is None:
+                raise CommandError('Only containers kept in files can be '
+                                   'moved, to a backend that keeps files')
+            self.lock(container, options.get('wait', 60))
+            try:
+                moved = self.migrate(container, new_backend)
+                container.storage_backend = backend_path
+                Container.objects.filter(pk=container.pk).update(
+                    storage_backend=backend_path)
+                container.reconcile()
+            finally:
+                Container.objects.filter(pk=container.pk).update(
+                    read_only=False)
+                container.read_only = False
+            if verbosity:
+                self.stdout.write('%s/%s: %s objects moved to %s\n' % (
+                    container.account.user.username, container.name, moved,
+                    backend_path))
+    
+    def lock(self, container, wait):
+        """
+        Make ``container`` read only, then wait up to ``wait`` seconds for the
+        uploads and copies in progress to finish
+        """
+        Container.objects.filter(pk=container.pk).update(read_only=True)
+        container.read_only = True
+        time.sleep(SETTLE_TIME)
+        deadline = time.time() + wait
+        while True:
+            writing = container.backend.writes_in_progress(container.path)
+            if not writing:
+                return
+            if time.time() >= deadline:
+                Container.objects.filter(pk=container.pk).update(
+                    read_only=False)
+                container.read_only = False
+                raise CommandError('%s/%s has writes in progress, or left '
+                    'behind by a crash: %s' % (container.account.user.username,
+                    container.name, ', '.join(sorted(writing)[:10])))
+            time.sleep(1)
+    
+    def migrate(self, container, new_backend):
+        """
+        Copy the objects of ``container`` to ``new_backend`` and put the new
+        copy in place of the old one. Files are hard linked where possible,
+        so no data is copied and cached checksums stay valid. Returns the
+        number of objects moved.
+        
+        Nothing is changed if the container directory holds files that aren't
+        objects, such as hidden files, since they would be lost.
+        """
+        old_backend = container.backend
+        root = os.path.normpath(container.path)
+        new_root = os.path.join(os.path.dirname(root), '.%s.%s' % (
+            os.path.basename(root), uuid.uuid4().hex))
+        new_backend.create_container(new_root)
+        moved = set()
+        try:
+            for name, stat in old_backend.walk(root):
+                new_path = new_backend.local_path(new_root, name)
+                if not os.path.isdir(os.path.dirname(new_path)):
+                    os.makedirs(os.path.dirname(new_path))
+                old_path = old_backend.local_path(root, name)
+                copy_file(old_path, new_path, True, settings.UPLOAD_CHUNK_SIZE)
+                moved.add(old_path)
+            left = [os.path.join(dirpath, filename)
+                    for dirpath, dirnames, filenames in os.walk(root)
+                    for filename in filenames
+                    if os.path.join(dirpath, filename) not in moved]
+            if left:
+                raise CommandError('%s/%s holds files that are not objects, '
+                    'which would be lost; move them away first: %s' % (
+                    container.account.user.username, container.name,
+                    ', '.join(sorted(left)[:10])))
+        except:
+            shutil.rmtree(new_root, ignore_errors=True)
+            raise
+        
+        old_root = new_root + '.old'
+        os.rename(root, old_root)
+        os.rename(new_root, root)
+        shutil.rmtree(old_root)
+        return len(moved)
@@ -0,0 +1,46 @@
+"""
+Rebuild the container usage counters and name indexes from what is on disk,
+and the account usage counters from those of their containers
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from rapid.models import Account, Container
+
+class Command(BaseCommand):
+    """
+    Walk each container, store its real object count and bytes used and 
+    rebuild its name index, then total the usage of the affected accounts
+    """
+    args = '[<account>/<container> ...]'
+    help = ('Rebuild the object and byte counters and the name index of the '
+            'given containers, or of every container, from the files on disk.')
+    
+    def handle(self, *args, **options):
+        """Reconcile the requested containers"""
+        containers = Container.objects.select_related('account__user')
+        if args:
+            selected = []
+            for arg in args:
+                try:
+                    account_name, container_name = arg.split('/', 1)
+                    selected.append(containers.get(
+                        account__user__username=account_name, 
+                        name=container_name))
+                except (ValueError, Container.DoesNotExist):
+                    raise CommandError('Unknown container "%s"' % arg)
+            containers = selected
+        
+        verbosity = int(options.get('verbosity', 1))
+        account_ids = set()
+        for container in containers:
+            account_ids.add(container.account_id)
+            old_counts = (container.object_count, container.bytes_used)
+            container.reconcile()
+            new_counts = (container.object_count, container.bytes_used)
+            if verbosity > 1 or (verbosity and old_counts != new_counts):
+                self.stdout.write('%s/%s: %s objects, %s bytes (was %s, %s)\n' % (
+                    container.account.user.username, container.name,
+                    new_counts[0], new_counts[1], old_counts[0], old_counts[1]))
+        
+        for account in Account.objects.filter(pk__in=account_ids):
+            account.recalculate_usage()
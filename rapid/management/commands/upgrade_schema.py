@@ -0,0 +1,87 @@
+"""
+Bring the rapid tables of an existing database up to date with the models
+"""
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.core.management.sql import custom_sql_for_model
+from django.db import connection, transaction
+
+from rapid.models import Account, Container, ObjectInfo, hash_name
+
+# Existing containers were all created before there was a choice of layout
+EXISTING_VALUES = {
+    'storage_backend': 'rapid.storage.PosixBackend',
+}
+
+class Command(BaseCommand):
+    """
+    Add the columns the models have gained to their tables, fill them in for
+    the existing rows, then create the missing tables
+    """
+    help = ('Add the columns and indexes the rapid tables have gained since '
+            'they were created, then create the missing tables. Run '
+            'reconcile_containers afterwards to fill in the usage counters and '
+            'name indexes.')
+    
+    def handle(self, *args, **options):
+        """Upgrade the tables"""
+        verbosity = int(options.get('verbosity', 1))
+        cursor = connection.cursor()
+        tables = connection.introspection.table_names()
+        added = []
+        for model in (Account, Container, ObjectInfo):
+            table = model._meta.db_table
+            if table not in tables:
+                continue
+            columns = set(row[0] for row in
+                connection.introspection.get_table_description(cursor, table))
+            for field in model._meta.local_fields:
+                if field.column not in columns:
+                    self.add_column(cursor, model, field)
+                    added.append(field)
+                    if verbosity:
+                        self.stdout.write('Added %s.%s\n' % (table,
+                                                             field.column))
+        transaction.commit_unless_managed()
+        if ObjectInfo._meta.get_field('name_hash') in added:
+            self.hash_names(cursor)
+            # The collation and index syncdb sets up for new name indexes
+            for sql in custom_sql_for_model(ObjectInfo, no_style(), connection):
+                cursor.execute(sql)
+            transaction.commit_unless_managed()
+        
+        call_command('syncdb', verbosity=verbosity, interactive=False)
+        if added and verbosity:
+            self.stdout.write('Now run reconcile_containers to count the '
+                              'objects of every container.\n')
+    
+    def add_column(self, cursor, model, field):
+        """
+        Add the column of ``field`` to the table of ``model``, and give the
+        existing rows its default value. The column allows ``NULL``, as not
+        every database can add a ``NOT NULL`` column to a table with rows.
+        """
+        quote_name = connection.ops.quote_name
+        cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            quote_name(model._meta.db_table), quote_name(field.column),
+            field.db_type(connection=connection)))
+        value = EXISTING_VALUES.get(field.name, field.get_default())
+        if value is not None:
+            model._default_manager.update(**{field.name: value})
+    
+    def hash_names(self, cursor):
+        """
+        Fill in the name hashes of the existing name index entries, and make
+        them unique for each container as the names are
+        """
+        for pk, name in ObjectInfo.objects.values_list('pk', 'name').iterator():
+            ObjectInfo.objects.filter(pk=pk).update(name_hash=hash_name(name))
+        quote_name = connection.ops.quote_name
+        opts = ObjectInfo._meta
+        cursor.execute('CREATE UNIQUE INDEX %s ON %s (%s, %s)' % (
+            quote_name('%s_name_hash' % opts.db_table),
+            quote_name(opts.db_table),
+            quote_name(opts.get_field('container').column),
+            quote_name(opts.get_field('name_hash').column)))
+        transaction.commit_unless_managed()
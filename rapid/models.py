@@ -1,4 +1,6 @@
 import os
+import sys
+import time
 import datetime
 import mimetypes
 
@@ -7,43 +9,218 @@ try:
 except ImportError:
     from md5 import md5
 
-from django.db import models
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count, Sum
 from django.contrib.auth.models import User
 
-class DirectoryNotEmpty(Exception):
-    """Exception when trying to delete a non-empty directory"""
-    pass
+from storage import (get_storage_backend, check_object_name, 
+                     DirectoryNotEmpty, InvalidObjectName, NameConflict)
+from checksums import compute_checksums
+from instrumentation import instrumented
+import settings
+
+def encode_metadata(metadata):
+    """
+    The user metadata dictionary ``metadata`` as stored in :class:`ObjectInfo`
+    """
+    if not metadata:
+        return ''
+    return json.dumps(metadata, sort_keys=True)
+
+def hash_name(name):
+    """
+    The md5 of the object name ``name``, which keeps names unique in 
+    :class:`ObjectInfo` in databases that can't index long strings
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return md5(name).hexdigest()
+
+def names_after(prefix):
+    """
+    A marker that sorts after every name starting with ``prefix``
+    """
+    if isinstance(prefix, unicode):
+        return prefix + u'\U0010ffff'
+    return prefix + '\xff'
 
 class StorageObject(object):
     """
     An abstract way to get files/objects in a container (file system)
+    
+    Listings create thousands of storage objects, so they only hold what the 
+    storage backend or the name index returned. The names, paths and dates 
+    derived from it are built when they are asked for.
     """
+    __slots__ = ('container', 'object_name', 'exists', 'isdir', 'bytes', 
+                 'mtime', 'inode', '_hash', '_content_type', '_info')
+    
     def __init__(self, container, path):
         """
-        Instantiate a storage object.
+        Instantiate a storage object. Raises 
+        :exc:`rapid.storage.InvalidObjectName` for a name that can't name an 
+        object in the container.
+        """
+        check_object_name(path)
+        self.container = container
+        self.object_name = path
+        self.refresh()
+    
+    @classmethod
+    def entry(cls, container, name, isdir=False, size=0, mtime=None, 
+              inode=None):
+        """
+        Build a storage object that exists from what a listing found, without 
+        touching the storage backend.
+        """
+        sobj = cls.__new__(cls)
+        sobj.container = container
+        sobj.object_name = name
+        sobj.exists = True
+        sobj.isdir = isdir
+        sobj.bytes = size
+        sobj.mtime = mtime
+        sobj.inode = inode
+        return sobj
+    
+    @classmethod
+    def from_info(cls, container, info, isdir=False):
+        """
+        Build a storage object from its entry in the name index, without 
+        touching the storage backend.
+        """
+        sobj = cls.entry(container, info.name, isdir, info.size, info.mtime, 
+                         info.inode)
+        if info.md5:
+            sobj._hash = info.md5 # pylint: disable-msg=W0212
+        sobj._info = info # pylint: disable-msg=W0212
+        return sobj
+    
+    @classmethod
+    def from_stat(cls, container, name, stat):
+        """
+        Build a storage object from the :class:`rapid.storage.ObjectStat` a 
+        backend listing returned with its name
+        """
+        sobj = cls.entry(container, name, stat.isdir, stat.size, stat.mtime, 
+                         stat.inode)
+        if stat.isdir:
+            # Directories have no entry in the name index
+            sobj._info = None # pylint: disable-msg=W0212
+        return sobj
+    
+    @property
+    def path(self):
+        """
+        The path of the object under the container's path
+        """
+        return os.path.join(self.container.path, self.object_name)
+    
+    @property
+    def name(self):
+        """
+        The last part of the object's name, or ``''`` if it doesn't exist
+        """
+        if not self.exists:
+            return ''
+        name = self.object_name
+        return name[name.rstrip('/').rfind('/') + 1:]
+    
+    @property
+    def full_name(self):
+        """
+        The object's name with a leading ``/``, or ``''`` if it doesn't exist
+        """
+        if not self.exists:
+            return ''
+        return '/' + self.object_name
+    
+    @property
+    def modified(self):
+        """
+        When the contents were uploaded, as a timestamp, or ``None``. This is 
+        the time recorded with them, as names with the same content may share
+        a file, or the file's modification time if it changed since.
+        """
+        if self.isdir:
+            return self.mtime
+        info = self.info
+        if info is not None and info.modified is not None and \
+                self.stat_is_current(info):
+            return info.modified
+        return self.mtime
+    
+    @property
+    def last_modified(self):
+        """
+        The upload time as a ``datetime``, or ``None``
+        """
+        modified = self.modified
+        if modified is None:
+            return None
+        return datetime.datetime.fromtimestamp(modified)
+    
+    @property
+    def backend(self):
+        """
+        The storage backend holding the object
+        """
+        return self.container.backend
+    
+    def refresh(self):
+        """
+        (Re)load what the storage backend knows about the object
         """
-        self.path = os.path.join(container.path, path.lstrip('.'))
-        self.name = ''
-        self.full_name = ''
+        self.set_stat(self.backend.stat(self.container.path, self.object_name))
+    
+    def set_stat(self, stat):
+        """
+        Describe the object with ``stat``, a 
+        :class:`rapid.storage.ObjectStat`, or as missing when it is ``None``
+        """
+        for attr in ('_hash', '_content_type', '_info'):
+            if hasattr(self, attr):
+                delattr(self, attr)
+        self.exists = False
         self.isdir = False
         self.bytes = 0
-        self.last_modified = None
-        self.container = container
-        if self.exists:
-            head, tail = os.path.split(self.path)
-            stat_info = os.stat(self.path)
-            self.isdir = os.path.isdir(self.path)
-            if self.isdir:
-                self.bytes = 0
-            else:
-                self.bytes = stat_info[7]
-            self.last_modified = datetime.datetime.fromtimestamp(stat_info[9])
-            if tail:
-                self.name = tail
-            elif head and not tail:
-                self.name = head.split('/')[-1]
-            self.full_name = self.path.replace(self.container.path, '', 1)
+        self.mtime = None
+        self.inode = None
+        if stat is not None:
+            self.exists = True
+            self.mtime = stat.mtime
+            self.inode = stat.inode
+            self.isdir = stat.isdir
+            self.bytes = stat.size
     
+    @property
+    def local_path(self):
+        """
+        The path of the object's file, or ``None`` if the storage backend 
+        doesn't keep it in a file of its own
+        """
+        return self.backend.local_path(self.container.path, self.object_name)
+    
+    def open(self):
+        """
+        Return a file object to read the object from
+        """
+        return self.backend.open(self.container.path, self.object_name)
+    
+    def iter_range(self, first, length, chunk_size):
+        """
+        Yield ``length`` bytes of the object starting at ``first``, at most 
+        ``chunk_size`` bytes at a time
+        """
+        return self.backend.iter_range(self.container.path, self.object_name, 
+                                       first, length, chunk_size)
+    
+    @instrumented('hash')
     def compute_md5sum(self):
         """
         Given an open file object, returns the md5 hexdigest of the data.
@@ -54,7 +231,7 @@ class StorageObject(object):
         fobj = None
         try:
             try:
-                fobj = open(self.path)
+                fobj = self.open()
                 buff = fobj.read(4096)
                 while buff:
                     checksum.update(buff)
@@ -72,18 +249,178 @@ class StorageObject(object):
         Delete the file. Raise an exception if it is a non-empty dir
         """
         if self.isdir:
-            if len(os.listdir(self.path)) != 0:
-                raise DirectoryNotEmpty()
-            else:
-                os.rmdir(self.path)
+            self.backend.delete(self.container.path, self.object_name)
+        else:
+            self.backend.delete(self.container.path, self.object_name)
+            old = self.replace_info(None)
+            if old is not None and old.blob:
+                self.backend.release_blob(old.blob)
+    
+    def stat_is_current(self, info):
+        """
+        Was the cached ``info`` recorded for the file on disk?
+        """
+        return (info.size == self.bytes and info.mtime == self.mtime and 
+                info.inode == self.inode)
+    
+    def checksum_is_current(self, info):
+        """
+        Is the cached ``info`` still valid for the file on disk?
+        """
+        return bool(info.md5) and self.stat_is_current(info)
+    
+    def record_checksum(self, checksum, **extra):
+        """
+        Store ``checksum`` along with the current size, mtime and inode of the
+        file so it can be reused until the file changes. Any ``extra`` fields 
+        of the object's :class:`ObjectInfo` are stored too.
+        
+        Files added outside of the API get their entry here, and are counted 
+        in the usage counters from then on. The upload time of a file that
+        changed outside of the API is forgotten, so it is dated by its 
+        modification time.
+        """
+        values = {
+            'size': self.bytes,
+            'mtime': self.mtime,
+            'inode': self.inode,
+            'md5': checksum,
+            'modified': None,
+        }
+        values.update(extra)
+        self.replace_info(values)
+    
+    def replace_info(self, values):
+        """
+        Replace the :class:`ObjectInfo` of the object with one holding the 
+        ``values`` dictionary, or remove it when ``values`` is ``None``. The 
+        usage counters change by the difference with the entry replaced, so 
+        they keep adding up the name index when writes and deletes of the 
+        object overlap. Returns the entry replaced, or ``None``.
+        """
+        try:
+            return self._replace_info(values)
+        except IntegrityError:
+            # An overlapping write created the entry first
+            return self._replace_info(values)
+    
+    @transaction.commit_on_success
+    def _replace_info(self, values):
+        """
+        Replace the entry and update the usage counters in one transaction
+        """
+        if hasattr(self, '_info'):
+            del self._info
+        entries = self.container.objectinfo_set.filter(name=self.object_name)
+        # Lock the entry until the transaction ends, so that overlapping 
+        # writes and deletes wait for each other's changes
+        entries.update(size=F('size'))
+        try:
+            old = entries.get()
+        except ObjectInfo.DoesNotExist:
+            old = None
+        if values is None:
+            entries.delete()
+        elif old is not None:
+            entries.update(**values)
         else:
-            os.remove(self.path)
+            self.container.objectinfo_set.create(name=self.object_name, 
+                                                 **values)
+        objects = (values is not None) - (old is not None)
+        num_bytes = (values is not None and values['size'] or 0) - \
+                    (old is not None and old.size or 0)
+        self.container.update_usage(objects, num_bytes)
+        return old
+    
+    @property
+    def info(self):
+        """
+        The :class:`ObjectInfo` of the object, or ``None``
+        """
+        if not hasattr(self, '_info'):
+            try:
+                self._info = self.container.objectinfo_set.get(
+                    name=self.object_name)
+            except ObjectInfo.DoesNotExist:
+                self._info = None
+        return self._info
+    
+    @property
+    def manifest(self):
+        """
+        The ``<container>/<prefix>`` of the segments that make up the object,
+        if it is a large object manifest
+        """
+        info = self.info
+        return info is not None and info.manifest or ''
+    
+    @property
+    def metadata(self):
+        """
+        The user metadata of the object, a dictionary of the ``X-Object-Meta-``
+        header names, without the prefix, to their values
+        """
+        info = self.info
+        if info is None or not info.metadata:
+            return {}
+        return json.loads(info.metadata)
+    
+    def set_metadata(self, metadata):
+        """
+        Replace the user metadata of the object with the ``metadata`` 
+        dictionary. The file isn't read: an object without an entry in the 
+        name index gets one with its checksum left to compute.
+        """
+        encoded = encode_metadata(metadata)
+        if hasattr(self, '_info'):
+            del self._info
+        entries = self.container.objectinfo_set.filter(name=self.object_name)
+        if not entries.update(metadata=encoded):
+            self.record_checksum('', metadata=encoded)
+    
+    def segment_container(self):
+        """
+        Return the container of the segments named by the manifest, or 
+        ``None`` if there is no such container
+        """
+        container_name = self.manifest.partition('/')[0]
+        try:
+            return self.container.account.container_set.get(
+                name=container_name)
+        except Container.DoesNotExist:
+            return None
+    
+    def manifest_segments(self):
+        """
+        Return the storage objects named by the manifest, in name order, with 
+        their cached checksums loaded
+        """
+        prefix = self.manifest.partition('/')[2]
+        container = self.segment_container()
+        if container is None:
+            return []
+        segments = container.iter_storage_objects(limit=sys.maxint, 
+                                                  prefix=prefix)
+        segments = [segment for segment in segments
+                    if not segment.isdir and segment.path != self.path]
+        return list(container.with_checksums(segments, parallel=True))
     
     @property
     def hash(self):
-        """Return an md5sum"""
+        """
+        Return an md5sum. The checksum cache is used when the file hasn't
+        changed since the checksum was recorded.
+        """
         if not hasattr(self, '_hash'):
-            self._hash = self.compute_md5sum()
+            if self.isdir:
+                self._hash = ''
+                return self._hash
+            info = self.info
+            if info is not None and self.checksum_is_current(info):
+                self._hash = info.md5
+            else:
+                self._hash = self.compute_md5sum()
+                self.record_checksum(self._hash)
         return self._hash
     
     @property
@@ -96,20 +433,96 @@ class StorageObject(object):
             self._content_type = ctype or 'application/octet-stream'
         return self._content_type
     
-    @property
-    def exists(self):
+    def write(self, content, manifest='', metadata=None):
+        """
+        Set the contents of the file to ``content``, a string or an iterable 
+        of strings. A ``manifest`` makes the object a large object made of 
+        the segments it names. The user metadata of the object is replaced 
+        with the ``metadata`` dictionary.
+        
+        The md5 checksum is computed as the data is written and recorded with 
+        the object, so the ETag is ready without reading the file again. 
+        Returns the checksum.
+        
+        The new contents replace the old ones atomically. The checksum is 
+        recorded with the stat of the data this call wrote, so if another 
+        upload to the same name wins the race, its own entry replaces this 
+        one, or this one no longer matches the file and is ignored.
+        
+        With ``DEDUPLICATE_OBJECTS``, the data is stored once per distinct 
+        content in the blob store and the object is a hard link to its blob.
+        """
+        if isinstance(content, basestring):
+            content = [content]
+        checksum = md5()
+        
+        def hashed():
+            """Checksum the chunks on their way to the backend"""
+            for chunk in content:
+                checksum.update(chunk)
+                yield chunk
+        
+        stat, blob = self.backend.write(self.container.path, self.object_name, 
+                                        hashed(), settings.DEDUPLICATE_OBJECTS)
+        self.set_stat(stat)
+        self._hash = checksum.hexdigest()
+        self.record_contents(self._hash, manifest, blob, metadata)
+        return self._hash
+    
+    def record_contents(self, checksum, manifest, blob, metadata):
         """
-        Does the file exist?
+        Index the contents just written, with their ``checksum``, large 
+        object ``manifest``, ``blob`` key, user ``metadata`` dictionary and 
+        upload time, and release the blob of the contents they replaced
         """
-        return os.path.exists(self.path)
+        old = self.replace_info({
+            'size': self.bytes,
+            'mtime': self.mtime,
+            'inode': self.inode,
+            'modified': time.time(),
+            'md5': checksum,
+            'manifest': manifest,
+            'blob': blob,
+            'metadata': encode_metadata(metadata),
+        })
+        if old is not None and old.blob and old.blob != blob:
+            self.backend.release_blob(old.blob)
     
-    def write(self, content):
+    def copy_from(self, source, metadata=None):
         """
-        Set the contents of the file to ``content``
+        Make the object a copy of the ``source`` storage object without 
+        reading it into memory. The user metadata of the source is copied, 
+        updated with the ``metadata`` dictionary.
+        
+        The copy is a hard link to the source when ``COPY_USE_HARDLINKS`` or 
+        ``DEDUPLICATE_OBJECTS`` is set and both are on the same file system, 
+        otherwise a reflink where the file system supports it, otherwise a 
+        chunked copy. The source's cached checksum and large object manifest 
+        are carried over. Sources in a container of another storage backend 
+        are streamed into the object as it is written. Returns the checksum.
         """
-        os.makedirs(os.path.dirname(self.path))
-        myfile = open(self.path, 'wb')
-        myfile.write(content)
+        new_metadata = source.metadata
+        new_metadata.update(metadata or {})
+        if source.path == self.path:
+            self.set_metadata(new_metadata)
+            return source.hash
+        if source.backend is not self.backend:
+            return self.write(source.iter_range(0, source.bytes, 
+                                                settings.UPLOAD_CHUNK_SIZE),
+                              source.manifest, new_metadata)
+        stat, checksum = self.backend.copy(source.container.path, 
+            source.object_name, self.container.path, self.object_name, 
+            settings.COPY_USE_HARDLINKS or settings.DEDUPLICATE_OBJECTS)
+        if checksum is None:
+            checksum = source.hash
+        self.set_stat(stat)
+        # A hard link to the source refers to the source's blob too
+        blob = ''
+        if self.inode == source.inode and source.info is not None:
+            blob = source.info.blob
+        self._hash = checksum
+        self.record_contents(self._hash, source.manifest, blob, new_metadata)
+        return self._hash
     
     def read(self, num_bytes=None):
         """
@@ -117,7 +530,7 @@ class StorageObject(object):
         """
         output = ''
         try:
-            thefile = open(self.path)
+            thefile = self.open()
             if num_bytes is not None:
                 output = thefile.read(num_bytes)
             else:
@@ -153,6 +566,40 @@ class Account(models.Model):
         blank=True, 
         default=datetime.datetime.now,
         help_text="When the Auth Token")
+    container_count = models.BigIntegerField(default=0, editable=False)
+    object_count = models.BigIntegerField(default=0, editable=False)
+    bytes_used = models.BigIntegerField(default=0, editable=False)
+    
+    @classmethod
+    def update_usage(cls, account_id, containers=0, objects=0, num_bytes=0):
+        """
+        Atomically add to the usage counters of the account ``account_id``
+        """
+        if not containers and not objects and not num_bytes:
+            return
+        cls.objects.filter(pk=account_id).update(
+            container_count=F('container_count') + containers,
+            object_count=F('object_count') + objects,
+            bytes_used=F('bytes_used') + num_bytes)
+    
+    def recalculate_usage(self):
+        """
+        Rebuild the usage counters from the counters of the containers
+        """
+        totals = self.container_set.aggregate(containers=Count('id'), 
+            objects=Sum('object_count'), num_bytes=Sum('bytes_used'))
+        self.container_count = totals['containers']
+        self.object_count = totals['objects'] or 0
+        self.bytes_used = totals['num_bytes'] or 0
+        Account.objects.filter(pk=self.pk).update(
+            container_count=self.container_count, 
+            object_count=self.object_count, bytes_used=self.bytes_used)
+
+def default_storage_backend():
+    """
+    New containers keep the storage backend configured when they are created
+    """
+    return settings.STORAGE_BACKEND
 
 class Container(models.Model):
     """
@@ -167,31 +614,113 @@ class Container(models.Model):
     cdn_url = models.CharField(blank=True, max_length=255)
     cdn_ttl = models.IntegerField(blank=True, null=True)
     cdn_log_retention = models.BooleanField(default=False)
+    indexed = models.BooleanField(default=False, editable=False,
+        help_text="Objects are listed from the name index instead of walking "
+                  "the directory tree.")
+    object_count = models.BigIntegerField(default=0, editable=False)
+    bytes_used = models.BigIntegerField(default=0, editable=False)
+    storage_backend = models.CharField(blank=True, max_length=255, 
+        default=default_storage_backend, editable=False,
+        help_text="The storage backend class the objects are kept with. "
+                  "Change it with the migrate_storage command.")
+    read_only = models.BooleanField(default=False, editable=False,
+        help_text="Writes are refused while the objects are moved to another "
+                  "storage backend.")
     
     class Meta:
         unique_together = ('account', 'name')
     
+    @property
+    def backend(self):
+        """
+        The storage backend holding the objects of the container
+        """
+        return get_storage_backend(self.storage_backend)
+    
+    @transaction.commit_on_success
+    def update_usage(self, objects=0, num_bytes=0):
+        """
+        Atomically add ``objects`` and ``num_bytes`` to the usage counters of
+        the container and its account
+        """
+        if not objects and not num_bytes:
+            return
+        Container.objects.filter(pk=self.pk).update(
+            object_count=F('object_count') + objects,
+            bytes_used=F('bytes_used') + num_bytes)
+        Account.update_usage(self.account_id, objects=objects, 
+                             num_bytes=num_bytes)
+        self.object_count += objects
+        self.bytes_used += num_bytes
+    
+    def walk_files(self):
+        """
+        Yield the name and :class:`rapid.storage.ObjectStat` of every object 
+        in the container
+        """
+        return self.backend.walk(self.path)
+    
+    @transaction.commit_on_success
+    def reconcile(self):
+        """
+        Rebuild the usage counters and the name index from the files on disk.
+        Index entries for changed files lose their cached checksum and upload
+        time, and replaced files their blob reference.
+        """
+        indexed = dict((info.name, info) for info in self.objectinfo_set.all())
+        object_count = bytes_used = 0
+        for name, stat in self.walk_files():
+            object_count += 1
+            bytes_used += stat.size
+            info = indexed.pop(name, None)
+            values = (stat.size, stat.mtime, stat.inode)
+            if info is None:
+                self.objectinfo_set.create(name=name, size=values[0], 
+                    mtime=values[1], inode=values[2])
+            elif (info.size, info.mtime, info.inode) != values:
+                if info.inode != values[2]:
+                    info.blob = ''
+                info.size, info.mtime, info.inode = values
+                info.md5 = ''
+                info.modified = None
+                info.save()
+        stale = [info.pk for info in indexed.values()]
+        for start in range(0, len(stale), 500):
+            ObjectInfo.objects.filter(pk__in=stale[start:start + 500]).delete()
+        
+        old_counts = Container.objects.filter(pk=self.pk).values_list(
+            'object_count', 'bytes_used')[0]
+        self.object_count = object_count
+        self.bytes_used = bytes_used
+        self.indexed = True
+        Container.objects.filter(pk=self.pk).update(
+            object_count=object_count, bytes_used=bytes_used, indexed=True)
+        Account.update_usage(self.account_id, 
+                             objects=object_count - old_counts[0], 
+                             num_bytes=bytes_used - old_counts[1])
+    
+    def is_empty(self):
+        """
+        Does the container hold no objects? Uses the usage counters before 
+        asking the storage backend.
+        """
+        if self.object_count:
+            return False
+        return self.backend.is_empty(self.path)
+    
     @property
     def total_size(self):
         """
         Get the total space occupied by this container
         """
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(self.path):
-            for name in filenames:
-                fileptr = os.path.join(dirpath, name)
-                total_size += os.path.getsize(fileptr)
-        return total_size
+        return self.backend.usage(self.path)[1]
     
     @property
     def file_count(self):
         """
         Recursively count the number of files within a path
         """
-        total_count = 0
-        for dirpath, dirnames, filenames in os.walk(self.path):
-            total_count += len(filenames)
-        return total_count
+        return self.backend.usage(self.path)[0]
     
     def storage_objects(self, limit=10000, marker=None, prefix='', path=None, 
                         delimiter=''):
@@ -222,6 +751,19 @@ class Container(models.Model):
         
         container path + prefix/path + marker(if marker > prefix)
         """
+        return list(self.iter_storage_objects(limit, marker, prefix, path, 
+                                              delimiter))
+    
+    def iter_storage_objects(self, limit=10000, marker=None, prefix='', 
+                             path=None, delimiter='', stat=True):
+        """
+        Yield the storage objects matching the criteria of 
+        :meth:`storage_objects` as they are found.
+        
+        Without ``stat``, objects listed by the storage backend only have 
+        their names and ``isdir`` set, which saves a stat per object for 
+        listings of names.
+        """
         if path is not None:
             prefix = path = path.lstrip('.')
             if path:
@@ -229,35 +771,147 @@ class Container(models.Model):
             delimiter = '/'
         elif delimiter and not prefix:
             prefix = ''
-        if marker and marker > prefix:
-            marker_path = os.path.join(self.path, marker)
-            start_path = os.path.dirname(marker_path) + '/'
-        else:
-            start_path = prefix and os.path.join(self.path, prefix) or self.path
-            marker_path = start_path
-        results = []
+        if self.indexed:
+            for sobj in self.iter_indexed_objects(limit, marker, prefix or '', 
+                                                  delimiter or ''):
+                yield sobj
+            return
+        if limit <= 0:
+            return
+        prefix = prefix or ''
+        count, start = 0, marker or ''
+        while True:
+            dirname = None
+            for name, obj_stat in self.backend.list(self.path, prefix, start, 
+                                                    stat):
+                if obj_stat.isdir:
+                    # Like the name index, only list objects and the 
+                    # directories their names are rolled up into
+                    continue
+                nested = -1
+                if delimiter:
+                    nested = name.find(delimiter, len(prefix))
+                if nested >= 0:
+                    dirname = name[:nested + len(delimiter)]
+                    break
+                yield StorageObject.from_stat(self, name, obj_stat)
+                count += 1
+                if count >= limit:
+                    return
+            if dirname is None:
+                return
+            if not marker or dirname > marker:
+                sobj = StorageObject.entry(self, dirname, True, 
+                                           mtime=obj_stat.mtime)
+                sobj._info = None # pylint: disable-msg=W0212
+                yield sobj
+                count += 1
+                if count >= limit:
+                    return
+            # List again from after the rest of this directory
+            start = names_after(dirname)
+    
+    def iter_indexed_objects(self, limit=10000, marker=None, prefix='', 
+                             delimiter='', batch_size=1000):
+        """
+        Yield storage objects from the name index, in name order.
         
-        for dirpath, dirnames, filenames in os.walk(start_path, topdown=False):
-            if len(results) >= limit:
-                break
-            if os.path.commonprefix([self.path, dirpath]) != self.path:
+        The index is read with range queries of at most ``batch_size`` rows. 
+        With a ``delimiter``, names nested below ``prefix`` are rolled up into 
+        a single directory entry, named up to and including the delimiter, and 
+        the query seeks past the rest of that directory instead of reading it.
+        The seek relies on the database comparing names by code point, as the
+        name column is set up by ``syncdb`` and ``upgrade_schema`` to do.
+        """
+        entries = self.objectinfo_set.order_by('name')
+        if prefix:
+            entries = entries.filter(name__startswith=prefix)
+        count = 0
+        lookup, start = 'name__gt', marker or ''
+        while count < limit:
+            batch = entries
+            if start:
+                batch = batch.filter(**{lookup: start})
+            batch = list(batch[:min(limit - count, batch_size)])
+            if not batch:
                 break
-            filesanddirs = filenames + dirnames
-            filesanddirs.sort()
-            for item in filesanddirs:
-                if os.path.join(dirpath, item) <= marker_path:
-                    continue
-                if item.startswith('.'):
-                    continue
-                relpath = os.path.join(dirpath.replace(self.path, '', 1), item)
-                results.append(StorageObject(self, relpath))
-                if len(results) >= limit:
+            lookup, start = 'name__gt', batch[-1].name
+            for info in batch:
+                nested = -1
+                if delimiter:
+                    nested = info.name.find(delimiter, len(prefix))
+                if nested >= 0:
+                    dirname = info.name[:nested + len(delimiter)]
+                    if not marker or dirname > marker:
+                        sobj = StorageObject.entry(self, dirname, True, 
+                                                   mtime=info.mtime)
+                        sobj._info = None # pylint: disable-msg=W0212
+                        yield sobj
+                        count += 1
+                    # The first name after every name in this directory
+                    lookup = 'name__gte'
+                    start = dirname[:-1] + unichr(ord(dirname[-1]) + 1)
+                    break
+                yield StorageObject.from_info(self, info)
+                count += 1
+                if count >= limit:
                     break
-        return results
+    
+    def prime_checksums(self, storage_objects, batch_size=500):
+        """
+        Load the :class:`ObjectInfo` entries, with the cached checksums and 
+        user metadata, for ``storage_objects`` in as few queries as possible. 
+        Objects whose cached checksum is missing or stale will be hashed when 
+        their ``hash`` is requested.
+        """
+        files = [sobj for sobj in storage_objects 
+                 if not sobj.isdir and not hasattr(sobj, '_info')]
+        for start in range(0, len(files), batch_size):
+            batch = dict((sobj.object_name, sobj) 
+                         for sobj in files[start:start + batch_size])
+            for sobj in batch.values():
+                sobj._info = None # pylint: disable-msg=W0212
+            infos = self.objectinfo_set.filter(name__in=batch.keys())
+            for info in infos:
+                sobj = batch[info.name]
+                sobj._info = info # pylint: disable-msg=W0212
+                if sobj.checksum_is_current(info):
+                    sobj._hash = info.md5 # pylint: disable-msg=W0212
+    
+    def with_checksums(self, storage_objects, batch_size=100, parallel=False, 
+                       timeout=None):
+        """
+        Yield ``storage_objects`` with their cached checksums and user 
+        metadata loaded, ``batch_size`` objects at a time.
+        
+        With ``parallel``, the checksums that aren't cached are computed for 
+        each batch on the checksum pool. Objects still not hashed ``timeout`` 
+        seconds after the first batch started get an empty checksum.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        batch = []
+        for sobj in storage_objects:
+            batch.append(sobj)
+            if len(batch) >= batch_size:
+                self.prime_checksums(batch)
+                if parallel:
+                    compute_checksums(batch, deadline)
+                for primed in batch:
+                    yield primed
+                batch = []
+        self.prime_checksums(batch)
+        if parallel:
+            compute_checksums(batch, deadline)
+        for primed in batch:
+            yield primed
     
     def get_storage_object(self, object_path):
         """
-        Turn a relative object path into a StorageObject
+        Turn a relative object path into a StorageObject. Raises 
+        :exc:`rapid.storage.InvalidObjectName` for paths with empty, ``.`` 
+        or ``..`` parts.
         """
         return StorageObject(container=self, path=object_path)
     
@@ -268,13 +922,69 @@ class Container(models.Model):
         return self.name
 
 
-from django.db.models.signals import post_delete
+class ObjectInfo(models.Model):
+    """
+    Cached information about a storage object. An entry is only valid while
+    the size, modification time and inode of the file match.
+    """
+    container = models.ForeignKey(Container)
+    name = models.CharField(max_length=1024)
+    name_hash = models.CharField(max_length=32, editable=False,
+        help_text="The md5 of the name, which keeps the names of a container "
+                  "unique.")
+    size = models.BigIntegerField(default=0)
+    mtime = models.FloatField(blank=True, null=True)
+    inode = models.BigIntegerField(blank=True, null=True)
+    modified = models.FloatField(blank=True, null=True,
+        help_text="When the contents were uploaded. Names with the same "
+                  "content share the modification time of their file.")
+    md5 = models.CharField(blank=True, max_length=32)
+    manifest = models.CharField(blank=True, max_length=1024,
+        help_text="The <container>/<prefix> of the segments of a large "
+                  "object.")
+    blob = models.CharField(blank=True, max_length=64,
+        help_text="The content hash of the deduplicated blob the object is "
+                  "linked to.")
+    metadata = models.TextField(blank=True,
+        help_text="The X-Object-Meta- headers of the object, in JSON.")
+    
+    class Meta:
+        # The name itself is too long for a unique index in MySQL
+        unique_together = ('container', 'name_hash')
+    
+    def save(self, *args, **kwargs):
+        """
+        Keep the name hash in step with the name
+        """
+        self.name_hash = hash_name(self.name)
+        super(ObjectInfo, self).save(*args, **kwargs)
+    
+    def __unicode__(self):
+        return self.name
+
+
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
+@receiver(post_save, sender=Container)
+def count_existing_objects(sender, instance, created, *args, **kwargs):
+    """
+    A new container may point at a directory that already holds files, so 
+    start its usage counters and name index from what is on disk
+    """
+    if created:
+        Account.update_usage(instance.account_id, containers=1)
+        if instance.backend.stat(instance.path, '') is not None:
+            instance.reconcile()
+
 @receiver(post_delete, sender=Container)
 def remove_container_path(sender, instance, *args, **kwargs):
     """
-    After the container is gone, remove the empty directory
+    After the container is gone, remove its usage from the account and 
+    remove its empty storage
     """
-    os.rmdir(instance.path)
+    Account.update_usage(instance.account_id, containers=-1, 
+                         objects=-instance.object_count, 
+                         num_bytes=-instance.bytes_used)
+    instance.backend.delete_container(instance.path)
 
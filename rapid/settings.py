@@ -1,3 +1,39 @@
+import os
+
 from django.conf import settings
 
-CONTAINER_LOCATION = getattr(settings, 'CONTAINER_LOCATION', 'storage')
\ No newline at end of file
+CONTAINER_LOCATION = getattr(settings, 'CONTAINER_LOCATION', 'storage')
+UPLOAD_CHUNK_SIZE = getattr(settings, 'UPLOAD_CHUNK_SIZE', 64 * 1024)
+
+DOWNLOAD_BACKEND = getattr(settings, 'DOWNLOAD_BACKEND', 
+                           'rapid.downloads.FileWrapperBackend')
+
+DOWNLOAD_CHUNK_SIZE = getattr(settings, 'DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+
+X_ACCEL_REDIRECT_PREFIX = getattr(settings, 'X_ACCEL_REDIRECT_PREFIX', 
+                                  '/protected/')
+
+COPY_USE_HARDLINKS = getattr(settings, 'COPY_USE_HARDLINKS', False)
+
+AUTH_TOKEN_CACHE_TTL = getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60)
+
+AUTH_TOKEN_CACHE_SIZE = getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 10000)
+
+AUTH_TOKEN_CACHE = getattr(settings, 'AUTH_TOKEN_CACHE', None)
+
+DEDUPLICATE_OBJECTS = getattr(settings, 'DEDUPLICATE_OBJECTS', False)
+
+BLOB_LOCATION = getattr(settings, 'BLOB_LOCATION', 
+                        os.path.join(CONTAINER_LOCATION, '.blobs'))
+
+STORAGE_BACKEND = getattr(settings, 'STORAGE_BACKEND', 
+                          'rapid.storage.PosixBackend')
+
+FSYNC_WRITES = getattr(settings, 'FSYNC_WRITES', False)
+
+CHECKSUM_WORKERS = getattr(settings, 'CHECKSUM_WORKERS', 4)
+
+CHECKSUM_TIMEOUT = getattr(settings, 'CHECKSUM_TIMEOUT', None)
+
+INSTRUMENTATION_LOG_INTERVAL = getattr(settings, 'INSTRUMENTATION_LOG_INTERVAL',
+                                       60)
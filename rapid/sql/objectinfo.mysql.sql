@@ -0,0 +1,5 @@
+-- Listings seek past directories assuming object names compare by code
+-- point, and read them in name order. Only the first 255 characters of a
+-- name fit in an index.
+ALTER TABLE rapid_objectinfo MODIFY name varchar(1024) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL;
+CREATE INDEX rapid_objectinfo_name ON rapid_objectinfo (container_id, name(255));
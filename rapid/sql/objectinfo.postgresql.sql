@@ -0,0 +1,4 @@
+-- Listings seek past directories assuming object names compare by code
+-- point, and read them in name order.
+ALTER TABLE rapid_objectinfo ALTER COLUMN name TYPE varchar(1024) COLLATE "C";
+CREATE INDEX rapid_objectinfo_name ON rapid_objectinfo (container_id, name);
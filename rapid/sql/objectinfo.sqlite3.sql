@@ -0,0 +1,3 @@
+-- Listings read object names in name order. SQLite compares them by code
+-- point already.
+CREATE INDEX rapid_objectinfo_name ON rapid_objectinfo (container_id, name);
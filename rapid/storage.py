@@ -0,0 +1,722 @@
+"""
+Storage backends keep the data of the objects in a container.
+
+Containers and storage objects only talk to the backend, so the layout of
+the data can change without touching the views. The backend is chosen with
+the ``STORAGE_BACKEND`` setting.
+
+Every method takes the ``root`` of a container, its ``path``, and the name
+of an object relative to it. The empty name is the container itself.
+"""
+import os
+import re
+import time
+import uuid
+import errno
+import urllib
+import threading
+from stat import S_ISDIR
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+try:
+    from hashlib import md5, sha256
+except ImportError:
+    from md5 import md5
+    sha256 = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from fileutils import (copy_file, link_blob, release_blob, fsync_directory, 
+                       scan_directory)
+from instrumentation import instrumented, instrumented_iter
+import settings
+
+class DirectoryNotEmpty(Exception):
+    """Exception when trying to delete a non-empty directory"""
+    pass
+
+
+class NameConflict(Exception):
+    """
+    Exception when an object can't be written because its name is taken by 
+    a directory, or one of its directories by an object
+    """
+    pass
+
+
+class InvalidObjectName(ValueError):
+    """Exception for a name that can't name an object in its container"""
+    pass
+
+
+def check_object_name(name):
+    """
+    Raise :exc:`InvalidObjectName` unless ``name`` is a relative name whose 
+    parts, between the ``/`` characters, are neither empty nor start with a 
+    ``.``. A trailing ``/`` names a directory.
+    
+    Names starting with ``.``, which include ``.`` and ``..``, are hidden: 
+    backends keep their own files under them, and skip them when they list, 
+    walk or move a container.
+    """
+    parts = name.split('/')
+    if len(parts) > 1 and not parts[-1]:
+        parts.pop()
+    for part in parts:
+        if not part or part.startswith('.') or '\0' in part:
+            raise InvalidObjectName(name)
+
+
+def is_inside(root, path):
+    """
+    Is the normalized ``path`` the directory ``root`` or below it?
+    """
+    root = os.path.normpath(root)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+class ObjectStat(object):
+    """
+    What a backend knows about an object without reading it
+    """
+    __slots__ = ('size', 'mtime', 'inode', 'isdir', 'nlink')
+    
+    def __init__(self, size=0, mtime=None, inode=None, isdir=False, nlink=1):
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.isdir = isdir
+        self.nlink = nlink
+    
+    @classmethod
+    def from_os_stat(cls, stat_info):
+        """
+        Build the stat of an object from the result of :func:`os.stat`
+        """
+        isdir = S_ISDIR(stat_info.st_mode)
+        return cls(not isdir and stat_info.st_size or 0, stat_info.st_mtime,
+                   stat_info.st_ino, isdir, stat_info.st_nlink)
+
+
+class StorageBackend(object):
+    """
+    The operations a storage backend provides. Subclasses implement all of
+    them except :meth:`iter_range` and :meth:`usage`.
+    """
+    def create_container(self, root):
+        """
+        Prepare the storage of a new container
+        """
+        raise NotImplementedError
+    
+    def delete_container(self, root):
+        """
+        Remove the storage of an empty container
+        """
+        raise NotImplementedError
+    
+    def stat(self, root, name):
+        """
+        Return the :class:`ObjectStat` of the object, or ``None`` if it
+        doesn't exist
+        """
+        raise NotImplementedError
+    
+    def local_path(self, root, name):
+        """
+        The path of the object's file, for the web server or other tools to
+        use, or ``None`` if the data isn't kept in a file of its own
+        """
+        return None
+    
+    def open(self, root, name):
+        """
+        Return a seekable file object to read the object from
+        """
+        raise NotImplementedError
+    
+    def iter_range(self, root, name, first, length, chunk_size):
+        """
+        Yield ``length`` bytes of the object starting at ``first``, at most
+        ``chunk_size`` bytes at a time
+        """
+        fileobj = self.open(root, name)
+        try:
+            fileobj.seek(first)
+            while length > 0:
+                chunk = fileobj.read(min(chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            fileobj.close()
+    
+    def write(self, root, name, chunks, deduplicate=False):
+        """
+        Replace the contents of the object with the strings of the iterable
+        ``chunks``, creating it if needed. The new contents must replace the 
+        old ones atomically.
+        
+        Returns the :class:`ObjectStat` of the new contents, and a blob key. 
+        Backends that can share the data of identical objects do so when
+        ``deduplicate`` is set, and return the key of the shared data, to
+        pass to :meth:`release_blob` when the object no longer uses it.
+        Otherwise the key is the empty string. Backends that can't keep an 
+        object and a directory of the same name raise :exc:`NameConflict`.
+        """
+        raise NotImplementedError
+    
+    def copy(self, src_root, src_name, root, name, use_hardlinks=False):
+        """
+        Replace the contents of the object with those of the object
+        ``src_name`` of the container ``src_root``, which uses this backend 
+        too. Returns the :class:`ObjectStat` of the copy and the md5 checksum
+        of the data if it had to be read, otherwise ``None``.
+        """
+        raise NotImplementedError
+    
+    def release_blob(self, blob):
+        """
+        Drop a reference to shared data returned by :meth:`write`
+        """
+        pass
+    
+    def delete(self, root, name):
+        """
+        Remove the object, or the directory ``name``. Raises
+        :exc:`DirectoryNotEmpty` for a directory that holds objects.
+        """
+        raise NotImplementedError
+    
+    def is_empty(self, root):
+        """
+        Does the container hold nothing at all?
+        """
+        raise NotImplementedError
+    
+    def list(self, root, prefix='', marker='', stat=True):
+        """
+        Yield the name and :class:`ObjectStat` of the objects and directories
+        of the container whose names start with ``prefix`` and sort after
+        ``marker``. Names are yielded in order where the backend can.
+        
+        Without ``stat``, only the ``isdir`` of the stats has to be filled 
+        in, for listings that only show names.
+        """
+        raise NotImplementedError
+    
+    def walk(self, root):
+        """
+        Yield the name and :class:`ObjectStat` of every object in the
+        container, in no particular order. Directories are left out.
+        """
+        raise NotImplementedError
+    
+    def usage(self, root):
+        """
+        Return the number of objects in the container and the bytes they use
+        """
+        object_count = bytes_used = 0
+        for name, stat in self.walk(root):
+            object_count += 1
+            bytes_used += stat.size
+        return object_count, bytes_used
+
+
+class PosixBackend(StorageBackend):
+    """
+    Keep each object in a file at its name under the container directory, so
+    containers can be any directory on the server and their files are served
+    as they are. Hidden files and directories are ignored.
+    """
+    # Names with a trailing / and the directories of other names are the 
+    # paths of directories
+    has_directories = True
+    
+    def create_container(self, root):
+        """
+        Create the container directory
+        """
+        if not os.path.isdir(root):
+            os.makedirs(root)
+    
+    def delete_container(self, root):
+        """
+        Remove the empty container directory
+        """
+        os.rmdir(root)
+    
+    @instrumented('stat')
+    def stat(self, root, name):
+        """
+        Stat the file of the object
+        """
+        try:
+            stat_info = os.stat(self.local_path(root, name))
+        except OSError, err:
+            if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise
+        return ObjectStat.from_os_stat(stat_info)
+    
+    def local_path(self, root, name):
+        """
+        The path of the object under the container directory. Raises 
+        :exc:`InvalidObjectName` for a name that leads out of it.
+        """
+        path = os.path.normpath(os.path.join(root, name))
+        if not is_inside(root, path):
+            raise InvalidObjectName(name)
+        return path
+    
+    def open(self, root, name):
+        """
+        Open the file of the object
+        """
+        return open(self.local_path(root, name), 'rb')
+    
+    def prepare_path(self, root, name):
+        """
+        Create the directory of the object if needed and return the path of
+        its file. Raises :exc:`NameConflict` if the name is a directory's, or
+        one of its directories is a file.
+        """
+        path = self.local_path(root, name)
+        if self.has_directories and (name.endswith('/') or 
+                                     os.path.isdir(path)):
+            raise NameConflict(name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, err:
+                # Another upload created it in the meantime
+                if err.errno not in (errno.EEXIST, errno.ENOTDIR):
+                    raise
+            if not os.path.isdir(dirname):
+                raise NameConflict(name)
+        return path
+    
+    def rename_into_place(self, temp_path, path, name):
+        """
+        Rename the new contents at ``temp_path`` to the object's ``path``. 
+        Raises :exc:`NameConflict` if a directory took the name in the 
+        meantime.
+        """
+        try:
+            os.rename(temp_path, path)
+        except OSError, err:
+            if err.errno in (errno.EISDIR, errno.ENOTDIR, errno.ENOTEMPTY, 
+                             errno.EEXIST):
+                raise NameConflict(name)
+            raise
+    
+    # The names of the files of uploads and copies in progress
+    temp_name = re.compile(r'^\..+\.[0-9a-f]{32}(\.blob)?$')
+    
+    def temp_path(self, path):
+        """
+        A unique hidden path next to ``path``, to prepare new contents in
+        """
+        return os.path.join(os.path.dirname(path), '.%s.%s' % (
+            os.path.basename(path), uuid.uuid4().hex))
+    
+    def writes_in_progress(self, root):
+        """
+        The paths of the temporary files of the uploads and copies being 
+        written to the container
+        """
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            paths.extend(os.path.join(dirpath, filename) 
+                         for filename in filenames 
+                         if self.temp_name.match(filename))
+        return paths
+    
+    def write(self, root, name, chunks, deduplicate=False):
+        """
+        Write the new contents to a temporary file next to the object's file 
+        and rename it into place, so readers see either the old or the new 
+        contents, never part of them. When several writes to the same object 
+        overlap, the last one renamed wins. The file is flushed to disk first 
+        with ``FSYNC_WRITES``.
+        
+        With ``deduplicate``, the file is made a hard link to the blob with 
+        the same content in ``BLOB_LOCATION`` before it is renamed.
+        """
+        path = self.prepare_path(root, name)
+        digest = deduplicate and sha256 is not None and sha256() or None
+        temp_path = self.temp_path(path)
+        try:
+            myfile = open(temp_path, 'wb')
+            try:
+                for chunk in chunks:
+                    if digest is not None:
+                        digest.update(chunk)
+                    myfile.write(chunk)
+                if settings.FSYNC_WRITES:
+                    myfile.flush()
+                    os.fsync(myfile.fileno())
+            finally:
+                myfile.close()
+            blob = ''
+            if digest is not None and link_blob(settings.BLOB_LOCATION, 
+                                                temp_path, digest.hexdigest()):
+                blob = digest.hexdigest()
+            stat = ObjectStat.from_os_stat(os.stat(temp_path))
+            self.rename_into_place(temp_path, path, name)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if settings.FSYNC_WRITES:
+            fsync_directory(os.path.dirname(path))
+        return stat, blob
+    
+    def copy(self, src_root, src_name, root, name, use_hardlinks=False):
+        """
+        Copy the file with :func:`rapid.fileutils.copy_file` to a temporary 
+        file and rename it into place
+        """
+        path = self.prepare_path(root, name)
+        temp_path = self.temp_path(path)
+        try:
+            checksum = copy_file(self.local_path(src_root, src_name),
+                                 temp_path, use_hardlinks,
+                                 settings.UPLOAD_CHUNK_SIZE)
+            stat = ObjectStat.from_os_stat(os.stat(temp_path))
+            self.rename_into_place(temp_path, path, name)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if settings.FSYNC_WRITES:
+            fsync_directory(os.path.dirname(path))
+        return stat, checksum
+    
+    def release_blob(self, blob):
+        """
+        Remove the blob once no object is linked to it
+        """
+        release_blob(settings.BLOB_LOCATION, blob)
+    
+    def delete(self, root, name):
+        """
+        Remove the file, or the empty directory
+        """
+        path = self.local_path(root, name)
+        if os.path.isdir(path):
+            if os.listdir(path):
+                raise DirectoryNotEmpty()
+            os.rmdir(path)
+        else:
+            os.remove(path)
+    
+    @instrumented('stat')
+    def is_empty(self, root):
+        """
+        Is the container directory missing or empty?
+        """
+        return not os.path.isdir(root) or not os.listdir(root)
+    
+    def scan_tree(self, path):
+        """
+        Yield each directory below ``path``, and ``path`` itself last, with
+        its entries sorted by name, deepest directories first. Hidden files 
+        and directories are skipped.
+        """
+        try:
+            entries = [entry for entry in scan_directory(path)
+                       if not entry.name.startswith('.')]
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir():
+                for item in self.scan_tree(entry.path):
+                    yield item
+        yield path, entries
+    
+    def iter_tree(self, root, dirname, prefix, marker):
+        """
+        Yield the name and directory entry of everything below the directory
+        ``dirname`` whose name starts with ``prefix`` and sorts after 
+        ``marker``, in name order, reading each subdirectory only when the 
+        listing reaches it.
+        
+        A directory's own entry sorts by its name, and what it holds by its 
+        name and a ``/``, so ``a``, ``a-b``, ``a/1`` and ``a0`` are yielded 
+        in that order. Subdirectories holding no wanted name aren't read.
+        """
+        try:
+            entries = scan_directory(os.path.join(root, dirname))
+        except OSError:
+            return
+        keys = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            name = dirname + entry.name
+            subtree = name + '/'
+            wanted = name.startswith(prefix) and name > marker
+            below = ((subtree.startswith(prefix) or prefix.startswith(subtree))
+                     and (marker < subtree or marker.startswith(subtree)))
+            if not wanted and not below:
+                continue
+            if wanted:
+                keys.append((name, entry, False))
+            if below and entry.is_dir():
+                keys.append((subtree, entry, True))
+        keys.sort(key=lambda key: key[0])
+        for name, entry, descend in keys:
+            if descend:
+                for item in self.iter_tree(root, name, prefix, marker):
+                    yield item
+            else:
+                yield name, entry
+    
+    @instrumented_iter('walk')
+    def list(self, root, prefix='', marker='', stat=True):
+        """
+        Yield the entries of the directory tree whose names start with 
+        ``prefix`` and sort after ``marker``, in name order, as they are 
+        found. The listing starts in the directory named by ``prefix``, and 
+        stops reading directories as soon as the caller stops asking for 
+        entries. Each entry is stat'ed once at most, and not at all without 
+        ``stat``.
+        """
+        dirname = prefix[:prefix.rfind('/') + 1]
+        for part in dirname.split('/')[:-1]:
+            if not part or part.startswith('.'):
+                # Hidden or outside the container
+                return
+        for name, entry in self.iter_tree(root, dirname, prefix, marker):
+            if not stat:
+                yield name, ObjectStat(isdir=entry.is_dir())
+                continue
+            try:
+                stat_info = entry.stat()
+            except OSError:
+                continue
+            yield name, ObjectStat.from_os_stat(stat_info)
+    
+    @instrumented_iter('walk')
+    def walk(self, root):
+        """
+        Walk the container directory, skipping hidden files and directories
+        """
+        for dirpath, entries in self.scan_tree(root):
+            for entry in entries:
+                if entry.is_dir():
+                    continue
+                try:
+                    stat_info = entry.stat()
+                except OSError:
+                    continue
+                yield (entry.path[len(root):].lstrip('/'),
+                       ObjectStat.from_os_stat(stat_info))
+
+
+class ShardedBackend(PosixBackend):
+    """
+    Spread the files of a container over up to 65536 directories, two levels
+    of 256, picked by the md5 of the object name, so no directory grows too
+    large however many objects share a prefix. Files are named after their
+    object name with every special character, ``/`` included, escaped.
+    
+    Directories don't exist in this layout, and the order of names on disk
+    is lost, so containers are listed from the name index.
+    """
+    has_directories = False
+    
+    def local_path(self, root, name):
+        """
+        The path of the object's file in its shard
+        """
+        if not name:
+            return root
+        shard = md5(name.encode('utf-8')).hexdigest()
+        return os.path.join(root, shard[:2], shard[2:4], 
+                            urllib.quote(name.encode('utf-8'), safe=''))
+    
+    def delete_container(self, root):
+        """
+        Remove the empty shard directories and the container directory
+        """
+        for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+            os.rmdir(dirpath)
+    
+    @instrumented('walk')
+    def is_empty(self, root):
+        """
+        Is there no file in any shard?
+        """
+        for name, stat in self.walk(root):
+            return False
+        return True
+    
+    @instrumented_iter('walk')
+    def list(self, root, prefix='', marker='', stat=True):
+        """
+        Yield the objects in name order. Every shard has to be read first.
+        """
+        objects = [(name, stat) for name, stat in self.walk(root)
+                   if name.startswith(prefix) and name > marker]
+        objects.sort()
+        return iter(objects)
+    
+    def walk(self, root):
+        """
+        Yield the objects of every shard, with the names unescaped
+        """
+        for name, stat in super(ShardedBackend, self).walk(root):
+            yield (urllib.unquote(os.path.basename(name)).decode('utf-8'), 
+                   stat)
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keep objects in memory, in the process. For tests and for comparing the
+    cost of the file system with none at all; nothing survives a restart.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = set()
+        # (root, name) -> (data, ObjectStat)
+        self.objects = {}
+        self.next_inode = 1
+    
+    def names(self, root):
+        """
+        The sorted names of the objects in the container
+        """
+        return sorted(name for obj_root, name in self.objects.keys()
+                      if obj_root == root)
+    
+    def create_container(self, root):
+        """
+        Remember the container
+        """
+        self.roots.add(root)
+    
+    def delete_container(self, root):
+        """
+        Forget the container
+        """
+        if not self.is_empty(root):
+            raise DirectoryNotEmpty()
+        self.roots.discard(root)
+    
+    def stat(self, root, name):
+        """
+        Look up the object. Directories exist while they hold objects.
+        """
+        entry = self.objects.get((root, name))
+        if entry is not None:
+            return entry[1]
+        if not name:
+            return root in self.roots and ObjectStat(isdir=True) or None
+        dirname = name.rstrip('/') + '/'
+        for obj_root, obj_name in self.objects.keys():
+            if obj_root == root and obj_name.startswith(dirname):
+                return ObjectStat(isdir=True)
+        return None
+    
+    def open(self, root, name):
+        """
+        A file object over the data of the object
+        """
+        try:
+            return StringIO(self.objects[(root, name)][0])
+        except KeyError:
+            raise IOError(errno.ENOENT, 'No such object', name)
+    
+    def store(self, root, name, data):
+        """
+        Store ``data`` as the contents of the object and return its stat
+        """
+        self.lock.acquire()
+        try:
+            stat = ObjectStat(len(data), time.time(), self.next_inode)
+            self.next_inode += 1
+            self.objects[(root, name)] = (data, stat)
+        finally:
+            self.lock.release()
+        return stat
+    
+    def write(self, root, name, chunks, deduplicate=False):
+        """
+        Store the joined ``chunks``. Identical strings aren't shared.
+        """
+        return self.store(root, name, ''.join(chunks)), ''
+    
+    def copy(self, src_root, src_name, root, name, use_hardlinks=False):
+        """
+        Store the data of the source object under the new name
+        """
+        try:
+            data = self.objects[(src_root, src_name)][0]
+        except KeyError:
+            raise IOError(errno.ENOENT, 'No such object', src_name)
+        return self.store(root, name, data), None
+    
+    def delete(self, root, name):
+        """
+        Forget the object. Directories can't be empty, so deleting one is an
+        error.
+        """
+        if (root, name) not in self.objects:
+            if self.stat(root, name) is not None:
+                raise DirectoryNotEmpty()
+            raise OSError(errno.ENOENT, 'No such object', name)
+        del self.objects[(root, name)]
+    
+    def is_empty(self, root):
+        """
+        Does the container hold no objects?
+        """
+        for obj_root, name in self.objects.keys():
+            if obj_root == root:
+                return False
+        return True
+    
+    def list(self, root, prefix='', marker='', stat=True):
+        """
+        Yield the objects in name order
+        """
+        for name in self.names(root):
+            if name.startswith(prefix) and name > marker:
+                entry = self.objects.get((root, name))
+                if entry is not None:
+                    yield name, entry[1]
+    
+    def walk(self, root):
+        """
+        Yield every object of the container
+        """
+        return self.list(root)
+
+
+_backends = {}
+
+def get_storage_backend(backend_path=None):
+    """
+    Return an instance of the storage backend class ``backend_path``, by 
+    default the configured ``STORAGE_BACKEND``
+    """
+    backend_path = backend_path or settings.STORAGE_BACKEND
+    if backend_path not in _backends:
+        module_name, _, class_name = backend_path.rpartition('.')
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError, ValueError), err:
+            raise ImproperlyConfigured(
+                'Error loading storage backend %s: "%s"' % (
+                    backend_path, err))
+        _backends[backend_path] = backend_class()
+    return _backends[backend_path]
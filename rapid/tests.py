@@ -1,6 +1,1131 @@
-# Test acount HEAD request: get correct headers 
+# Test acount HEAD request: get correct headers
 # Test account get request (no containers): get a 204 response
 # Test account get request: get list of container names
 # Test account get request with format json: get container info
 # Test account get request with format xml: get container info
-# Test account get request with format gibberish: get list of container names
\ No newline at end of file
+# Test account get request with format gibberish: get list of container names
+import os
+import shutil
+import time
+import datetime
+import tempfile
+from StringIO import StringIO
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from django.conf.urls.defaults import patterns, include
+from django.contrib.auth.models import User
+from django.core.management.base import CommandError
+from django.db import connection
+from django.http import HttpResponseNotFound, HttpResponseServerError
+from django.test import TestCase
+from django.test.client import Client
+from django.utils.http import http_date
+from django.utils import unittest
+
+from rapid import auth
+from rapid.checksums import compute_checksums
+from rapid.downloads import WSGIFileWrapperBackend, XSendfileBackend
+from rapid import instrumentation
+from rapid.management.commands import migrate_storage
+from rapid.models import Account, Container, ObjectInfo
+from rapid.storage import (InvalidObjectName, get_storage_backend, 
+                           PosixBackend, ShardedBackend, MemoryBackend)
+from rapid import storage
+from rapid import views
+from rapid import settings
+
+# The API, without templates for the error pages
+urlpatterns = patterns('', ('', include('rapid.urls')))
+handler404 = lambda request: HttpResponseNotFound()
+handler500 = lambda request: HttpResponseServerError()
+
+class RapidTestCase(TestCase):
+    """
+    Runs each test with the account ``joe``, holding the empty container
+    ``files``, and its containers kept in a temporary directory
+    """
+    urls = 'rapid.tests'
+    
+    def setUp(self):
+        self.location = tempfile.mkdtemp(prefix='rapid-test-')
+        self.old_settings = (settings.CONTAINER_LOCATION,
+                             settings.BLOB_LOCATION)
+        settings.CONTAINER_LOCATION = self.location
+        settings.BLOB_LOCATION = os.path.join(self.location, '.blobs')
+        user = User.objects.create(username='joe')
+        self.account = Account.objects.create(user=user, auth_key='key',
+            auth_token='joe-token',
+            token_expires=datetime.datetime.now() + datetime.timedelta(1))
+        self.client = Client(HTTP_X_AUTH_TOKEN='joe-token')
+        self.assertEqual(self.client.put('/v1/joe/files').status_code, 201)
+        self.container = Container.objects.get(name='files')
+    
+    def tearDown(self):
+        settings.CONTAINER_LOCATION, settings.BLOB_LOCATION = \
+            self.old_settings
+        shutil.rmtree(self.location, ignore_errors=True)
+    
+    def put(self, name, data, **extra):
+        """Upload ``data`` as the object ``name`` of ``files``"""
+        return self.client.put('/v1/joe/files/%s' % name, data,
+                               content_type='application/octet-stream',
+                               **extra)
+    
+    def get(self, name, **extra):
+        """Download the object ``name`` of ``files``"""
+        return self.client.get('/v1/joe/files/%s' % name, **extra)
+    
+    def add_file(self, name, data):
+        """Write the file of ``name`` directly in the container directory"""
+        outside = open(os.path.join(self.container.path, name), 'w')
+        outside.write(data)
+        outside.close()
+
+
+class ObjectNameTest(RapidTestCase):
+    """
+    Object names can't lead out of their container
+    """
+    def setUp(self):
+        super(ObjectNameTest, self).setUp()
+        secret = open(os.path.join(self.location, 'secret'), 'w')
+        secret.write('secret')
+        secret.close()
+        self.assertEqual(self.put('x/y', 'data').status_code, 204)
+    
+    def test_traversal(self):
+        for name in ('x/../../../secret', '../../secret', 'x/./y', 'x//y',
+                     '/x/y', './x/y', ''):
+            self.assertEqual(self.get(name).status_code, 404, name)
+            self.assertEqual(
+                self.client.head('/v1/joe/files/%s' % name).status_code,
+                404, name)
+            self.assertEqual(
+                self.client.delete('/v1/joe/files/%s' % name).status_code,
+                404, name)
+            self.assertEqual(self.put(name, 'new').status_code, 400, name)
+            self.assertEqual(self.put('copy', '',
+                HTTP_X_COPY_FROM='files/%s' % name).status_code, 404, name)
+        self.assertEqual(open(os.path.join(self.location, 'secret')).read(),
+                         'secret')
+        self.assertEqual(self.get('x/y').content, 'data')
+    
+    def test_public_container(self):
+        Container.objects.filter(pk=self.container.pk).update(is_public=True)
+        anonymous = Client()
+        self.assertEqual(anonymous.get('/v1/joe/files/x/y').status_code, 200)
+        self.assertEqual(anonymous.get(
+            '/v1/joe/files/x/../../../secret').status_code, 404)
+    
+    def test_local_path(self):
+        backend = get_storage_backend('rapid.storage.PosixBackend')
+        self.assertEqual(backend.local_path(self.container.path, 'x/y'),
+                         os.path.join(self.container.path, 'x', 'y'))
+        self.assertRaises(InvalidObjectName, backend.local_path,
+                          self.container.path, '../secret')
+        self.assertRaises(InvalidObjectName, backend.local_path,
+                          self.container.path, '/etc/passwd')
+
+
+class UploadTest(RapidTestCase):
+    """
+    Uploads replace objects whole or not at all
+    """
+    def test_truncated_body(self):
+        self.assertEqual(self.put('a', 'old').status_code, 204)
+        response = self.put('a', '', CONTENT_LENGTH='10', 
+                            **{'wsgi.input': StringIO('new')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get('a').content, 'old')
+        self.assertEqual(
+            self.container.backend.writes_in_progress(self.container.path), [])
+        self.assertEqual(Container.objects.get(pk=self.container.pk)
+                         .object_count, 1)
+        
+        response = self.put('b', '', CONTENT_LENGTH='10', 
+                            **{'wsgi.input': StringIO('new')})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.get('b').status_code, 404)
+
+
+class AccountListingTest(RapidTestCase):
+    """
+    Account listings report the stored counters, or on request what is on 
+    disk
+    """
+    def listing(self, **params):
+        """The counts and bytes of the containers of ``joe``, by name"""
+        params['format'] = 'json'
+        response = self.client.get('/v1/joe', params)
+        return dict((record['name'], (record['count'], record['bytes']))
+                    for record in json.loads(response.content))
+    
+    def test_counters(self):
+        self.assertEqual(self.put('a', 'hello').status_code, 204)
+        self.add_file('outside', 'data')
+        self.assertEqual(self.listing(), {'files': (1, 5)})
+        self.assertEqual(self.listing(fresh=1), {'files': (2, 9)})
+        # Nothing was stored
+        self.assertEqual(self.listing(), {'files': (1, 5)})
+        self.assertEqual(list(self.container.objectinfo_set.values_list(
+            'name', flat=True)), ['a'])
+
+
+class NameConflictTest(RapidTestCase):
+    """
+    A name can't be both an object and a directory
+    """
+    def setUp(self):
+        super(NameConflictTest, self).setUp()
+        for name in ('d/x', 'f'):
+            self.assertEqual(self.put(name, name).status_code, 204)
+    
+    def test_conflicts(self):
+        for name in ('d', 'd/', 'f/y', 'f/y/z', 'new/'):
+            self.assertEqual(self.put(name, 'data').status_code, 409, name)
+            self.assertEqual(self.put(name, '', 
+                HTTP_X_COPY_FROM='files/f').status_code, 409, name)
+        self.assertEqual(self.get('d/x').content, 'd/x')
+        self.assertEqual(self.get('f').content, 'f')
+        self.assertEqual(self.container.backend.writes_in_progress(
+            self.container.path), [])
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertEqual((container.object_count, container.bytes_used), 
+                         (2, 4))
+
+
+class UsageTest(RapidTestCase):
+    """
+    The usage counters add up the objects when writes and deletes overlap
+    """
+    def usage(self):
+        """The object and byte counters of ``files`` and ``joe``"""
+        container = Container.objects.get(pk=self.container.pk)
+        account = Account.objects.get(pk=self.account.pk)
+        return [(container.object_count, container.bytes_used), 
+                (account.object_count, account.bytes_used)]
+    
+    def test_overlapping_writes(self):
+        def content():
+            yield 'first'
+            self.container.get_storage_object('a').write('second upload')
+            yield ' upload'
+        self.container.get_storage_object('a').write(content())
+        self.assertEqual(self.usage(), [(1, 12)] * 2)
+        self.assertEqual(self.get('a').content, 'first upload')
+    
+    def test_delete_during_write(self):
+        self.assertEqual(self.put('a', 'old').status_code, 204)
+        def content():
+            yield 'new'
+            self.container.get_storage_object('a').delete()
+        self.container.get_storage_object('a').write(content())
+        self.assertEqual(self.usage(), [(1, 3)] * 2)
+        self.assertEqual(self.client.delete('/v1/joe/files/a').status_code, 
+                         204)
+        self.assertEqual(self.usage(), [(0, 0)] * 2)
+
+
+class OutsideFilesTest(RapidTestCase):
+    """
+    Files added outside of the API are counted once they are indexed
+    """
+    def usage(self):
+        """The object and byte counters of ``files`` and ``joe``"""
+        container = Container.objects.get(pk=self.container.pk)
+        account = Account.objects.get(pk=self.account.pk)
+        return [(container.object_count, container.bytes_used), 
+                (account.object_count, account.bytes_used)]
+    
+    def test_head_then_delete(self):
+        for indexed in (True, False):
+            Container.objects.filter(pk=self.container.pk).update(
+                indexed=indexed)
+            self.add_file('outside', 'hello')
+            self.assertEqual(self.client.head(
+                '/v1/joe/files/outside').status_code, 204)
+            self.assertEqual(self.usage(), [(1, 5)] * 2)
+            self.assertEqual(self.client.delete(
+                '/v1/joe/files/outside').status_code, 204)
+            self.assertEqual(self.usage(), [(0, 0)] * 2)
+    
+    def test_delete_unindexed(self):
+        self.add_file('outside', 'hello')
+        self.assertEqual(self.client.delete(
+            '/v1/joe/files/outside').status_code, 204)
+        self.assertEqual(self.usage(), [(0, 0)] * 2)
+
+
+class ChecksumCacheTest(RapidTestCase):
+    """
+    ETags come from the checksum cache until the file changes
+    """
+    def setUp(self):
+        super(ChecksumCacheTest, self).setUp()
+        self.assertEqual(self.put('a', 'hello').status_code, 204)
+        self.path = os.path.join(self.container.path, 'a')
+        self.opened = []
+        backend = self.container.backend
+        def open_object(root, name):
+            self.opened.append(name)
+            return type(backend).open(backend, root, name)
+        backend.open = open_object
+    
+    def tearDown(self):
+        del self.container.backend.open
+        super(ChecksumCacheTest, self).tearDown()
+    
+    def etag(self):
+        """The ETag a HEAD of ``a`` returns"""
+        return self.client.head('/v1/joe/files/a')['ETag']
+    
+    def test_cached(self):
+        self.assertEqual(self.etag(), md5('hello').hexdigest())
+        self.assertEqual(self.opened, [])
+    
+    def test_changed_mtime(self):
+        os.utime(self.path, (1000, 1000))
+        self.assertEqual(self.etag(), md5('hello').hexdigest())
+        self.assertEqual(self.opened, ['a'])
+        self.assertEqual(self.etag(), md5('hello').hexdigest())
+        self.assertEqual(self.opened, ['a'])
+    
+    def test_changed_size(self):
+        mtime = os.stat(self.path).st_mtime
+        self.add_file('a', 'hello, world')
+        os.utime(self.path, (mtime, mtime))
+        self.assertEqual(self.etag(), md5('hello, world').hexdigest())
+    
+    def test_changed_inode(self):
+        mtime = os.stat(self.path).st_mtime
+        self.add_file('b', 'jello')
+        os.utime(os.path.join(self.container.path, 'b'), (mtime, mtime))
+        os.rename(os.path.join(self.container.path, 'b'), self.path)
+        self.assertEqual(self.etag(), md5('jello').hexdigest())
+    
+    def test_overlapping_insert(self):
+        self.add_file('outside', 'hello')
+        original_save = ObjectInfo.save
+        def racing_save(info, *args, **kwargs):
+            # Another request indexes the file first
+            ObjectInfo.save = original_save
+            ObjectInfo(container=info.container, name=info.name).save()
+            return original_save(info, *args, **kwargs)
+        ObjectInfo.save = racing_save
+        try:
+            response = self.client.head('/v1/joe/files/outside')
+        finally:
+            ObjectInfo.save = original_save
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['ETag'], md5('hello').hexdigest())
+        self.assertEqual(self.container.objectinfo_set.get(
+            name='outside').md5, md5('hello').hexdigest())
+
+
+class MetadataTest(RapidTestCase):
+    """
+    User metadata is kept in the name index, apart from the contents
+    """
+    def head(self, name):
+        """The metadata headers of a HEAD and a GET of ``name``"""
+        responses = (self.client.head('/v1/joe/files/%s' % name), 
+                     self.get(name))
+        return [dict((key, value) for key, value in response.items()
+                     if key.startswith('X-Object-Meta-'))
+                for response in responses]
+    
+    def test_round_trip(self):
+        self.assertEqual(self.put('a', 'hello', HTTP_X_OBJECT_META_COLOR='red',
+                                  HTTP_X_OBJECT_META_FAVORITE_FOOD='pie'
+                                  ).status_code, 204)
+        self.assertEqual(self.head('a'), [{'X-Object-Meta-Color': 'red', 
+            'X-Object-Meta-Favorite-Food': 'pie'}] * 2)
+        self.assertEqual(self.client.post('/v1/joe/files/a', 
+            HTTP_X_OBJECT_META_COLOR='blue').status_code, 202)
+        self.assertEqual(self.head('a'), [{'X-Object-Meta-Color': 'blue'}] * 2)
+        self.assertEqual(self.get('a').content, 'hello')
+        self.assertEqual(self.put('a', 'jello').status_code, 204)
+        self.assertEqual(self.head('a'), [{}] * 2)
+    
+    def test_size_limit(self):
+        value = 'x' * (4096 - len('Color'))
+        self.assertEqual(self.put('a', 'hello', 
+            HTTP_X_OBJECT_META_COLOR=value + 'x').status_code, 400)
+        self.assertEqual(self.get('a').status_code, 404)
+        self.assertEqual(self.put('a', 'hello', 
+            HTTP_X_OBJECT_META_COLOR=value).status_code, 204)
+        self.assertEqual(self.client.post('/v1/joe/files/a', 
+            HTTP_X_OBJECT_META_COLOR=value + 'x').status_code, 400)
+        self.assertEqual(self.head('a'), [{'X-Object-Meta-Color': value}] * 2)
+    
+    def test_post_without_reading(self):
+        self.add_file('outside', 'hello')
+        backend = self.container.backend
+        backend.open = None
+        try:
+            self.assertEqual(self.client.post('/v1/joe/files/outside', 
+                HTTP_X_OBJECT_META_COLOR='red').status_code, 202)
+        finally:
+            del backend.open
+        self.assertEqual(self.head('outside'), 
+                         [{'X-Object-Meta-Color': 'red'}] * 2)
+        self.assertEqual(self.get('outside')['ETag'], md5('hello').hexdigest())
+    
+    def listing_queries(self):
+        """The number of queries a JSON listing of ``files`` makes"""
+        connection.use_debug_cursor = True
+        connection.queries = []
+        try:
+            response = self.client.get('/v1/joe/files', {'format': 'json'})
+            ''.join(response)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+    
+    def test_listing_queries(self):
+        for name in ('a', 'b'):
+            self.put(name, name, HTTP_X_OBJECT_META_COLOR='red')
+        queries = self.listing_queries()
+        for name in ('c', 'd', 'e', 'f'):
+            self.put(name, name, HTTP_X_OBJECT_META_COLOR='red')
+        self.assertEqual(self.listing_queries(), queries)
+
+
+class ChecksumPoolTest(RapidTestCase):
+    """
+    Listings hash the objects without a cached checksum on the pool
+    """
+    names = ('a', 'b', 'c')
+    
+    def setUp(self):
+        super(ChecksumPoolTest, self).setUp()
+        self.workers = settings.CHECKSUM_WORKERS
+        for name in self.names:
+            self.add_file(name, name * 3)
+        Container.objects.filter(pk=self.container.pk).update(indexed=False)
+        self.container = Container.objects.get(pk=self.container.pk)
+    
+    def tearDown(self):
+        settings.CHECKSUM_WORKERS = self.workers
+        super(ChecksumPoolTest, self).tearDown()
+    
+    def recorded(self):
+        """The checksums recorded for ``files``, by object name"""
+        return dict(self.container.objectinfo_set.values_list('name', 'md5'))
+    
+    def test_page_hashed(self):
+        expected = dict((name, md5(name * 3).hexdigest()) 
+                        for name in self.names)
+        for workers in (4, 1):
+            settings.CHECKSUM_WORKERS = workers
+            self.container.objectinfo_set.all().delete()
+            objects = self.container.storage_objects()
+            compute_checksums(objects)
+            self.assertEqual(dict((sobj.object_name, sobj._hash) 
+                                  for sobj in objects), expected)
+            self.assertEqual(self.recorded(), expected)
+    
+    def test_disabled(self):
+        settings.CHECKSUM_WORKERS = 0
+        objects = self.container.storage_objects()
+        compute_checksums(objects)
+        self.assertFalse([sobj for sobj in objects if hasattr(sobj, '_hash')])
+        self.assertEqual(self.recorded(), {})
+    
+    def test_deadline_passed(self):
+        objects = self.container.storage_objects()
+        compute_checksums(objects, deadline=time.time() - 1)
+        self.assertEqual([sobj._hash for sobj in objects], [''] * 3)
+        self.assertEqual(self.recorded(), {})
+
+
+class DeduplicationTest(RapidTestCase):
+    """
+    Objects with the same content share a file, but each is dated by its 
+    own upload
+    """
+    def setUp(self):
+        super(DeduplicationTest, self).setUp()
+        self.old_deduplicate = settings.DEDUPLICATE_OBJECTS
+        settings.DEDUPLICATE_OBJECTS = True
+    
+    def tearDown(self):
+        settings.DEDUPLICATE_OBJECTS = self.old_deduplicate
+        super(DeduplicationTest, self).tearDown()
+    
+    def test_last_modified(self):
+        self.assertEqual(self.put('a', 'data').status_code, 204)
+        path = os.path.join(self.container.path, 'a')
+        os.utime(path, (1000, 1000))
+        self.assertEqual(self.client.head('/v1/joe/files/a')['Last-Modified'],
+                         http_date(1000))
+        self.assertEqual(self.put('b', 'data').status_code, 204)
+        self.assertEqual(os.stat(path).st_ino, 
+                         os.stat(os.path.join(self.container.path, 'b')).st_ino)
+        self.assertEqual(os.stat(path).st_mtime, 1000)
+        response = self.client.head('/v1/joe/files/a')
+        self.assertEqual(response['Last-Modified'], http_date(1000))
+        self.assertEqual(response['ETag'], self.put('c', 'data')['ETag'])
+        self.assertEqual(self.client.head('/v1/joe/files/a', 
+            HTTP_IF_MODIFIED_SINCE=http_date(1000)).status_code, 304)
+        response = self.client.head('/v1/joe/files/b')
+        self.assertNotEqual(response['Last-Modified'], http_date(1000))
+        self.assertEqual(self.client.head('/v1/joe/files/b', 
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        listing = json.loads(self.client.get('/v1/joe/files', 
+                                             {'format': 'json'}).content)
+        uploaded = datetime.datetime.fromtimestamp(1000).isoformat()
+        self.assertEqual([record['last_modified'] == uploaded 
+                          for record in listing], [True, False, False])
+
+
+class DownloadTest(RapidTestCase):
+    """
+    Download backends open the file once per response
+    """
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        self.assertEqual(self.put('a', '0123456789').status_code, 204)
+        self.sobj = self.container.get_storage_object('a')
+        self.opened = []
+        backend = self.container.backend
+        def open_object(root, name):
+            fileobj = type(backend).open(backend, root, name)
+            self.opened.append(fileobj)
+            return fileobj
+        backend.open = open_object
+    
+    def tearDown(self):
+        del self.container.backend.open
+        super(DownloadTest, self).tearDown()
+    
+    def test_sendfile_relative_location(self):
+        cwd = os.getcwd()
+        os.chdir(self.location)
+        try:
+            settings.CONTAINER_LOCATION = 'relative'
+            self.assertEqual(self.client.put('/v1/joe/rel').status_code, 201)
+            self.assertEqual(self.client.put('/v1/joe/rel/a', 'data', 
+                content_type='application/octet-stream').status_code, 204)
+            sobj = Container.objects.get(name='rel').get_storage_object('a')
+            response = XSendfileBackend().serve(None, sobj)
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.location, 
+            'relative', 'joe', 'rel', 'a'))
+    
+    def test_range_to_end(self):
+        response = WSGIFileWrapperBackend().serve_range(self.sobj, 4, 9)
+        self.assertEqual(len(self.opened), 1)
+        self.assertTrue(response.file_to_stream is self.opened[0])
+        self.assertEqual(response['Content-Range'], 'bytes 4-9/10')
+        self.assertEqual(''.join(response), '456789')
+    
+    def test_range(self):
+        response = WSGIFileWrapperBackend().serve_range(self.sobj, 2, 4)
+        self.assertEqual(len(self.opened), 1)
+        self.assertEqual(getattr(response, 'file_to_stream', None), None)
+        self.assertEqual(''.join(response), '234')
+        self.assertTrue(self.opened[0].closed)
+
+
+class ConditionalRequestTest(RapidTestCase):
+    """
+    Downloads honour the conditional and range headers
+    """
+    def setUp(self):
+        super(ConditionalRequestTest, self).setUp()
+        self.assertEqual(self.put('a', '0123456789').status_code, 204)
+        self.etag = md5('0123456789').hexdigest()
+        self.modified = self.container.get_storage_object('a').modified
+    
+    def statuses(self, **headers):
+        """The statuses of a GET and a HEAD of ``a`` with ``headers``"""
+        return [self.get('a', **headers).status_code, 
+                self.client.head('/v1/joe/files/a', **headers).status_code]
+    
+    def test_if_match(self):
+        self.assertEqual(self.statuses(HTTP_IF_MATCH='"%s"' % self.etag), 
+                         [200, 204])
+        self.assertEqual(self.statuses(HTTP_IF_MATCH='"other", *'), 
+                         [200, 204])
+        self.assertEqual(self.statuses(HTTP_IF_MATCH='"other"'), [412, 412])
+    
+    def test_if_none_match(self):
+        self.assertEqual(self.statuses(
+            HTTP_IF_NONE_MATCH='"other", "%s"' % self.etag), [304, 304])
+        self.assertEqual(self.statuses(HTTP_IF_NONE_MATCH='*'), [304, 304])
+        self.assertEqual(self.statuses(HTTP_IF_NONE_MATCH='"other"'), 
+                         [200, 204])
+        # If-None-Match takes precedence over If-Modified-Since
+        self.assertEqual(self.statuses(HTTP_IF_NONE_MATCH='"other"', 
+            HTTP_IF_MODIFIED_SINCE=http_date(self.modified)), [200, 204])
+    
+    def test_if_modified_since(self):
+        self.assertEqual(self.statuses(
+            HTTP_IF_MODIFIED_SINCE=http_date(self.modified)), [304, 304])
+        self.assertEqual(self.statuses(
+            HTTP_IF_MODIFIED_SINCE=http_date(self.modified - 60)), [200, 204])
+        self.assertEqual(self.statuses(HTTP_IF_MODIFIED_SINCE='garbage'), 
+                         [200, 204])
+    
+    def test_if_unmodified_since(self):
+        self.assertEqual(self.statuses(
+            HTTP_IF_UNMODIFIED_SINCE=http_date(self.modified)), [200, 204])
+        self.assertEqual(self.statuses(
+            HTTP_IF_UNMODIFIED_SINCE=http_date(self.modified - 60)), 
+            [412, 412])
+    
+    def test_if_range(self):
+        for if_range in ('"%s"' % self.etag, http_date(self.modified)):
+            response = self.get('a', HTTP_RANGE='bytes=2-4', 
+                                HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 206, if_range)
+            self.assertEqual(response.content, '234')
+        for if_range in ('"other"', http_date(self.modified - 60)):
+            response = self.get('a', HTTP_RANGE='bytes=2-4', 
+                                HTTP_IF_RANGE=if_range)
+            self.assertEqual(response.status_code, 200, if_range)
+            self.assertEqual(response.content, '0123456789')
+    
+    def test_ranges(self):
+        for header, content in (('bytes=2-4', '234'), ('bytes=7-', '789'), 
+                                ('bytes=-3', '789'), ('bytes=8-20', '89')):
+            response = self.get('a', HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(response.content, content, header)
+            self.assertEqual(response['Content-Length'], str(len(content)))
+        self.assertEqual(self.get('a', HTTP_RANGE='bytes=4-2').content, 
+                         '0123456789')
+    
+    def test_unsatisfiable(self):
+        response = self.get('a', HTTP_RANGE='bytes=10-20')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+    
+    def test_multipart(self):
+        response = self.get('a', HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 206)
+        content_type, _, boundary = response['Content-Type'].partition(
+            '; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        content = response.content
+        self.assertEqual(response['Content-Length'], str(len(content)))
+        parts = content.split('--%s' % boundary)
+        self.assertEqual(parts[0], '')
+        self.assertEqual(parts[-1], '--\r\n')
+        self.assertEqual(parts[1:-1], [
+            '\r\nContent-Type: application/octet-stream\r\n'
+            'Content-Range: bytes %s/10\r\n\r\n%s\r\n' % part
+            for part in (('0-1', '01'), ('5-6', '56'))])
+
+
+class CopyTest(RapidTestCase):
+    """
+    Server-side copies are new files, dated when they are made
+    """
+    def test_copy(self):
+        self.assertEqual(self.put('a', 'data').status_code, 204)
+        path = os.path.join(self.container.path, 'a')
+        os.utime(path, (1000, 1000))
+        self.assertEqual(self.put('b', '', 
+            HTTP_X_COPY_FROM='files/a').status_code, 204)
+        copy_stat = os.stat(os.path.join(self.container.path, 'b'))
+        self.assertNotEqual(copy_stat.st_ino, os.stat(path).st_ino)
+        self.assertTrue(copy_stat.st_mtime > time.time() - 60)
+        self.assertEqual(self.get('b').content, 'data')
+    
+    def test_between_backends(self):
+        backend = settings.STORAGE_BACKEND
+        settings.STORAGE_BACKEND = 'rapid.storage.ShardedBackend'
+        try:
+            self.assertEqual(self.client.put('/v1/joe/sharded').status_code, 
+                             201)
+        finally:
+            settings.STORAGE_BACKEND = backend
+        self.assertEqual(self.put('a', 'data', 
+            HTTP_X_OBJECT_META_COLOR='red').status_code, 204)
+        self.assertEqual(self.client.put('/v1/joe/sharded/b', '', 
+            content_type='application/octet-stream', 
+            HTTP_X_COPY_FROM='files/a').status_code, 204)
+        response = self.client.get('/v1/joe/sharded/b')
+        self.assertEqual(response.content, 'data')
+        self.assertEqual(response['ETag'], md5('data').hexdigest())
+        self.assertEqual(response['X-Object-Meta-Color'], 'red')
+        self.assertEqual(self.put('c', '', 
+            HTTP_X_COPY_FROM='sharded/b').status_code, 204)
+        self.assertEqual(self.get('c').content, 'data')
+        self.assertEqual(self.get('c')['ETag'], md5('data').hexdigest())
+
+
+class ManifestTest(RapidTestCase):
+    """
+    Large objects are served as their segments, in name order
+    """
+    segments = (('part/2', 'world'), ('part/1', 'hello, '))
+    
+    def setUp(self):
+        super(ManifestTest, self).setUp()
+        self.assertEqual(self.client.put('/v1/joe/segments').status_code, 201)
+        for name, data in self.segments:
+            self.assertEqual(self.client.put('/v1/joe/segments/%s' % name, 
+                data, content_type='application/octet-stream').status_code, 
+                204)
+        self.assertEqual(self.put('big', '', 
+            HTTP_X_OBJECT_MANIFEST='segments/part/').status_code, 204)
+    
+    def test_get(self):
+        response = self.get('big')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'hello, world')
+        self.assertEqual(response['Content-Length'], '12')
+        self.assertEqual(response['ETag'], md5(md5('hello, ').hexdigest() + 
+                                               md5('world').hexdigest()
+                                               ).hexdigest())
+        self.assertEqual(response['X-Object-Manifest'], 'segments/part/')
+    
+    def test_head(self):
+        response = self.client.head('/v1/joe/files/big')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response['X-Object-Manifest'], 'segments/part/')
+        self.assertEqual(response['ETag'], self.get('big')['ETag'])
+    
+    def test_private_segments(self):
+        Container.objects.filter(pk=self.container.pk).update(is_public=True)
+        anonymous = Client()
+        self.assertEqual(anonymous.get('/v1/joe/files/big').status_code, 403)
+        self.assertEqual(anonymous.head('/v1/joe/files/big').status_code, 403)
+        self.assertEqual(self.get('big').content, 'hello, world')
+        Container.objects.filter(name='segments').update(is_public=True)
+        self.assertEqual(anonymous.get('/v1/joe/files/big').content, 
+                         'hello, world')
+    
+    def test_same_container(self):
+        for name, data in self.segments:
+            self.assertEqual(self.put(name, data).status_code, 204)
+        self.assertEqual(self.put('big', '', 
+            HTTP_X_OBJECT_MANIFEST='files/part/').status_code, 204)
+        Container.objects.filter(pk=self.container.pk).update(is_public=True)
+        self.assertEqual(Client().get('/v1/joe/files/big').content, 
+                         'hello, world')
+
+
+class BackendContract(object):
+    """
+    What every storage backend does, run against each of them in a 
+    temporary directory
+    """
+    backend_class = None
+    
+    def setUp(self):
+        self.backend = self.backend_class()
+        self.location = tempfile.mkdtemp(prefix='rapid-test-')
+        self.root = os.path.join(self.location, 'files')
+        self.backend.create_container(self.root)
+    
+    def tearDown(self):
+        shutil.rmtree(self.location, ignore_errors=True)
+    
+    def write(self, *names):
+        """Store each of ``names`` with its name as its contents"""
+        for name in names:
+            self.backend.write(self.root, name, [name[:1], name[1:]])
+    
+    def read(self, name):
+        """The contents of the object ``name``"""
+        fileobj = self.backend.open(self.root, name)
+        try:
+            return fileobj.read()
+        finally:
+            fileobj.close()
+    
+    def objects(self, prefix='', marker='', stat=True):
+        """The names of the objects, not the directories, listed"""
+        return [name for name, obj_stat in 
+                self.backend.list(self.root, prefix, marker, stat)
+                if not obj_stat.isdir]
+    
+    def test_write(self):
+        self.assertTrue(self.backend.is_empty(self.root))
+        self.assertEqual(self.backend.stat(self.root, 'a/b'), None)
+        stat, blob = self.backend.write(self.root, 'a/b', ['he', 'llo'])
+        self.assertEqual((stat.size, stat.isdir, blob), (5, False, ''))
+        self.assertEqual(self.backend.stat(self.root, 'a/b').size, 5)
+        self.assertEqual(self.read('a/b'), 'hello')
+        self.assertEqual(''.join(self.backend.iter_range(self.root, 'a/b', 
+                                                         1, 3, 2)), 'ell')
+        self.assertFalse(self.backend.is_empty(self.root))
+        
+        stat, blob = self.backend.write(self.root, 'a/b', ['bye'])
+        self.assertEqual(stat.size, 3)
+        self.assertEqual(self.read('a/b'), 'bye')
+    
+    def test_copy(self):
+        self.write('a/b')
+        stat, checksum = self.backend.copy(self.root, 'a/b', self.root, 'c')
+        self.assertEqual(stat.size, 3)
+        self.assertEqual(self.read('c'), 'a/b')
+        self.backend.write(self.root, 'a/b', ['new'])
+        self.assertEqual(self.read('c'), 'a/b')
+    
+    def test_delete(self):
+        self.write('a', 'b')
+        self.backend.delete(self.root, 'a')
+        self.assertEqual(self.backend.stat(self.root, 'a'), None)
+        self.assertEqual(self.objects(), ['b'])
+        self.assertRaises(OSError, self.backend.delete, self.root, 'a')
+        self.backend.delete(self.root, 'b')
+        self.assertTrue(self.backend.is_empty(self.root))
+        self.backend.delete_container(self.root)
+    
+    def test_list(self):
+        names = ['a!', 'a-b', 'a/1', 'a/2/x', 'a0', 'b/c']
+        self.write(*reversed(names))
+        self.assertEqual(self.objects(), names)
+        self.assertEqual(self.objects(stat=False), names)
+        self.assertEqual(self.objects(prefix='a/'), ['a/1', 'a/2/x'])
+        self.assertEqual(self.objects(prefix='a'), names[:5])
+        self.assertEqual(self.objects(marker='a-b'), names[2:])
+        self.assertEqual(self.objects(marker='a/1'), names[3:])
+        self.assertEqual(self.objects(prefix='a/', marker='a/1'), ['a/2/x'])
+        self.assertEqual(self.objects(prefix='c'), [])
+        for name, obj_stat in self.backend.list(self.root):
+            if not obj_stat.isdir:
+                self.assertEqual(obj_stat.size, len(name))
+    
+    def test_walk(self):
+        names = ['a', 'b/c', 'b/d/e']
+        self.write(*names)
+        self.assertEqual(sorted(name for name, obj_stat in 
+                                self.backend.walk(self.root)), names)
+        self.assertEqual(self.backend.usage(self.root), (3, 9))
+
+class PosixBackendTest(BackendContract, unittest.TestCase):
+    backend_class = PosixBackend
+
+class ShardedBackendTest(BackendContract, unittest.TestCase):
+    backend_class = ShardedBackend
+
+class MemoryBackendTest(BackendContract, unittest.TestCase):
+    backend_class = MemoryBackend
+
+
+class PosixListingTest(unittest.TestCase):
+    """
+    Directory trees are listed in name order, reading only the directories
+    that hold the names asked for
+    """
+    def setUp(self):
+        self.backend = PosixBackend()
+        self.root = tempfile.mkdtemp(prefix='rapid-test-')
+        for name in ('a/1', 'a/2/x', 'a-b', 'a0', 'b/c/d', 'b/e'):
+            self.backend.write(self.root, name, [name])
+        self.scanned = []
+        self.scan_directory = storage.scan_directory
+        def scan_directory(path):
+            self.scanned.append(os.path.relpath(path, self.root))
+            return self.scan_directory(path)
+        storage.scan_directory = scan_directory
+    
+    def tearDown(self):
+        storage.scan_directory = self.scan_directory
+        shutil.rmtree(self.root, ignore_errors=True)
+    
+    def names(self, prefix='', marker=''):
+        """The names listed"""
+        return [name for name, obj_stat in 
+                self.backend.list(self.root, prefix, marker)]
+    
+    def test_order(self):
+        self.assertEqual(self.names(), ['a', 'a-b', 'a/1', 'a/2', 'a/2/x', 
+                                        'a0', 'b', 'b/c', 'b/c/d', 'b/e'])
+    
+    def test_prefix(self):
+        self.assertEqual(self.names(prefix='b/'), ['b/c', 'b/c/d', 'b/e'])
+        self.assertEqual(sorted(self.scanned), ['b', 'b/c'])
+        del self.scanned[:]
+        self.assertEqual(self.names(prefix='a/2'), ['a/2', 'a/2/x'])
+        self.assertEqual(sorted(self.scanned), ['a', 'a/2'])
+    
+    def test_marker(self):
+        self.assertEqual(self.names(marker='a0'), ['b', 'b/c', 'b/c/d', 'b/e'])
+        self.assertEqual(sorted(self.scanned), ['.', 'b', 'b/c'])
+        del self.scanned[:]
+        self.assertEqual(self.names(marker='a/2/x'), 
+                         ['a0', 'b', 'b/c', 'b/c/d', 'b/e'])
+        self.assertEqual(sorted(self.scanned), ['.', 'a', 'a/2', 'b', 'b/c'])
+    
+    def test_lazy(self):
+        listing = self.backend.list(self.root)
+        self.assertEqual(listing.next()[0], 'a')
+        self.assertEqual(self.scanned, ['.'])
+        self.assertEqual([listing.next()[0] for i in range(2)], ['a-b', 'a/1'])
+        self.assertEqual(self.scanned, ['.', 'a'])
+
+
+class TokenCacheTest(RapidTestCase):
+    """
+    Replaced tokens are refused at once by every process sharing the cache
+    """
+    def setUp(self):
+        super(TokenCacheTest, self).setUp()
+        self.old_cache = settings.AUTH_TOKEN_CACHE
+        settings.AUTH_TOKEN_CACHE = 'locmem://'
+    
+    def tearDown(self):
+        auth._get_shared_cache().clear()
+        settings.AUTH_TOKEN_CACHE = self.old_cache
+        super(TokenCacheTest, self).tearDown()
+    
+    def test_replaced_token(self):
+        self.assertEqual(auth.get_token_account_name('joe-token'), 'joe')
+        self.assertEqual(auth.get_token_account_name('joe-token'), 'joe')
+        # Another process authenticates again
+        Account.objects.filter(pk=self.account.pk).update(
+            auth_token='new-token')
+        auth._get_shared_cache().delete(auth._cache_key('joe-token'))
+        self.assertEqual(auth.get_token_account_name('joe-token'), None)
+        self.assertEqual(auth.get_token_account_name('new-token'), 'joe')
+    
+    def test_cache_reused(self):
+        self.assertTrue(auth._get_shared_cache() is auth._get_shared_cache())
+
+
+class TokenRequiredTest(RapidTestCase):
+    """
+    Requests need a token for the account, except to read public containers
+    """
+    def setUp(self):
+        super(TokenRequiredTest, self).setUp()
+        self.assertEqual(self.put('a', 'data').status_code, 204)
+        user = User.objects.create(username='ann')
+        Account.objects.create(user=user, auth_key='key', 
+            auth_token='ann-token',
+            token_expires=datetime.datetime.now() + datetime.timedelta(1))
+    
+    def statuses(self, client):
+        """The statuses of ``client``'s requests to ``joe``"""
+        return {
+            'account': client.get('/v1/joe').status_code,
+            'list': client.get('/v1/joe/files').status_code,
+            'get': client.get('/v1/joe/files/a').status_code,
+            'head': client.head('/v1/joe/files/a').status_code,
+            'post': client.post('/v1/joe/files/a').status_code,
+            'put': client.put('/v1/joe/files/b', 'data', 
+                content_type='application/octet-stream').status_code,
+            'delete': client.delete('/v1/joe/files/a').status_code,
+        }
+    
+    def test_without_token(self):
+        for client in (Client(), Client(HTTP_X_AUTH_TOKEN='unknown')):
+            self.assertEqual(set(self.statuses(client).values()), set([401]))
+    
+    def test_other_account(self):
+        ann = Client(HTTP_X_AUTH_TOKEN='ann-token')
+        self.assertEqual(set(self.statuses(ann).values()), set([401]))
+        self.assertEqual(ann.put('/v1/ann/own').status_code, 201)
+    
+    def test_public_container(self):
+        Container.objects.filter(pk=self.container.pk).update(is_public=True)
+        for client in (Client(), Client(HTTP_X_AUTH_TOKEN='ann-token')):
+            self.assertEqual(self.statuses(client), {'account': 401, 
+                'list': 200, 'get': 200, 'head': 204, 'post': 401, 
+                'put': 401, 'delete': 401})
+        self.assertEqual(self.get('a').content, 'data')
+
+
+class InstrumentationTest(unittest.TestCase):
+    """
+    Timers are stopped however the timed code ends
+    """
+    def setUp(self):
+        self.stats = instrumentation._local.stats = \
+            instrumentation.RequestStats('test')
+    
+    def tearDown(self):
+        del instrumentation._local.stats
+    
+    def test_iter_error(self):
+        @instrumentation.instrumented_iter('walk')
+        def broken():
+            yield 1
+            raise IOError('disk gone')
+        iterator = broken()
+        self.assertEqual(iterator.next(), 1)
+        self.assertRaises(IOError, iterator.next)
+        self.assertEqual(self.stats.stack, [])
+        self.assertEqual(self.stats.calls, {'walk': 1})
+    
+    def test_iter(self):
+        @instrumentation.instrumented_iter('walk')
+        def items():
+            yield 1
+            yield 2
+        self.assertEqual(list(items()), [1, 2])
+        self.assertEqual(self.stats.stack, [])
+        self.assertEqual(self.stats.calls, {'walk': 1})
+
+
+class MigrateStorageTest(RapidTestCase):
+    """
+    Containers keep their objects when they move to another backend
+    """
+    def setUp(self):
+        super(MigrateStorageTest, self).setUp()
+        self.old_settle_time = migrate_storage.SETTLE_TIME
+        migrate_storage.SETTLE_TIME = 0
+        for name in ('a', 'b/c', 'b/d/e'):
+            self.assertEqual(self.put(name, name).status_code, 204)
+    
+    def tearDown(self):
+        migrate_storage.SETTLE_TIME = self.old_settle_time
+        super(MigrateStorageTest, self).tearDown()
+    
+    def migrate(self, backend_path):
+        """Move ``files`` to ``backend_path``"""
+        migrate_storage.Command().handle(backend_path, 'joe/files',
+                                         verbosity=0, wait=0)
+    
+    def test_round_trip(self):
+        self.migrate('rapid.storage.ShardedBackend')
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertEqual(container.storage_backend,
+                         'rapid.storage.ShardedBackend')
+        self.assertFalse(container.read_only)
+        self.assertEqual(self.get('b/d/e').content, 'b/d/e')
+        self.migrate('rapid.storage.PosixBackend')
+        for name in ('a', 'b/c', 'b/d/e'):
+            self.assertEqual(self.get(name).content, name)
+        self.assertEqual(Container.objects.get(pk=self.container.pk)
+                         .object_count, 3)
+    
+    def test_hidden_names(self):
+        self.assertEqual(self.put('b/.hidden', 'x').status_code, 400)
+        self.assertEqual(self.put('.hidden', 'x').status_code, 400)
+    
+    def test_files_that_are_not_objects(self):
+        hidden = os.path.join(self.container.path, 'b', '.hidden')
+        open(hidden, 'w').close()
+        self.assertRaises(CommandError, self.migrate,
+                          'rapid.storage.ShardedBackend')
+        self.assertTrue(os.path.exists(hidden))
+        container = Container.objects.get(pk=self.container.pk)
+        self.assertEqual(container.storage_backend,
+                         'rapid.storage.PosixBackend')
+        self.assertFalse(container.read_only)
+        self.assertEqual(self.get('b/c').content, 'b/c')
+    
+    def test_writes_in_progress(self):
+        temp = os.path.join(self.container.path, 'b', '.c.%s' % ('0' * 32))
+        open(temp, 'w').close()
+        self.assertRaises(CommandError, self.migrate,
+                          'rapid.storage.ShardedBackend')
+        self.assertFalse(Container.objects.get(pk=self.container.pk)
+                         .read_only)
+    
+    def test_read_only(self):
+        Container.objects.filter(pk=self.container.pk).update(read_only=True)
+        self.assertEqual(self.put('a', 'new').status_code, 503)
+        self.assertEqual(self.client.delete('/v1/joe/files/a').status_code,
+                         503)
+        self.assertEqual(self.client.post('/v1/joe/files/a').status_code,
+                         503)
+        self.assertEqual(self.get('a').content, 'a')
+
+
+def expected_listing(names, prefix='', marker='', delimiter='', limit=10000):
+    """
+    The listing of ``names`` by the rules of the name index
+    """
+    listing = []
+    for name in sorted(names):
+        if not name.startswith(prefix):
+            continue
+        if delimiter:
+            nested = name.find(delimiter, len(prefix))
+            if nested >= 0:
+                name = name[:nested + len(delimiter)]
+        if name > marker and name not in listing:
+            listing.append(name)
+    return listing[:limit]
+
+class ListingTest(RapidTestCase):
+    """
+    Containers list the same objects from the name index and from the 
+    storage backend
+    """
+    names = ('a!', 'a-b', 'a/1', 'a/2', 'a/b/c', 'a0', 'b/c', 'b/d/e', 'c')
+    
+    def setUp(self):
+        super(ListingTest, self).setUp()
+        for name in self.names:
+            self.assertEqual(self.put(name, name).status_code, 204)
+        self.container = Container.objects.get(pk=self.container.pk)
+        self.assertTrue(self.container.indexed)
+    
+    def listing(self, indexed, **criteria):
+        """The object names ``files`` lists"""
+        self.container.indexed = indexed
+        return [sobj.object_name 
+                for sobj in self.container.storage_objects(**criteria)]
+    
+    def test_listings(self):
+        for prefix in ('', 'a', 'a/', 'b/', 'x'):
+            for marker in ('', 'a', 'a-b', 'a/', 'a/1', 'a/b/', 'b/c'):
+                for delimiter in ('', '/', '-'):
+                    for limit in (1, 2, 10000):
+                        criteria = dict(prefix=prefix, marker=marker, 
+                                        delimiter=delimiter, limit=limit)
+                        expected = expected_listing(self.names, **criteria)
+                        self.assertEqual(self.listing(True, **criteria), 
+                                         expected, criteria)
+                        self.assertEqual(self.listing(False, **criteria), 
+                                         expected, criteria)
+    
+    def test_directories(self):
+        for indexed in (True, False):
+            self.assertEqual(self.listing(indexed, path='a'), 
+                             ['a/1', 'a/2', 'a/b/'])
+            objs = self.container.storage_objects(delimiter='/')
+            self.assertEqual([sobj.isdir for sobj in objs], 
+                             [False, False, True, False, True, False])
+    
+    def test_seek_between_batches(self):
+        names = [sobj.object_name for sobj in 
+                 self.container.iter_indexed_objects(delimiter='/', 
+                                                     batch_size=1)]
+        self.assertEqual(names, expected_listing(self.names, delimiter='/'))
+    
+    def test_json(self):
+        Container.objects.filter(pk=self.container.pk).update(indexed=False)
+        response = self.client.get('/v1/joe/files', 
+                                   {'format': 'json', 'delimiter': '/'})
+        self.assertEqual([record['name'] 
+                          for record in json.loads(response.content)],
+                         ['/' + name for name in 
+                          expected_listing(self.names, delimiter='/')])
+    
+    def test_streamed(self):
+        closed = []
+        close_connection = views.close_connection
+        views.close_connection = lambda: closed.append(True)
+        try:
+            for params in ({}, {'format': 'json'}, {'format': 'xml'}):
+                response = self.client.get('/v1/joe/files', params)
+                self.assertFalse(isinstance(response._container, 
+                                            (list, basestring)), params)
+                self.assertEqual(closed, [], params)
+                self.assertTrue('a/b/c' in ''.join(response), params)
+                self.assertEqual(closed, [True], params)
+                del closed[:]
+        finally:
+            views.close_connection = close_connection
@@ -3,12 +3,14 @@ Class-based views for handling the API calls
 """
 # pylint: disable-msg=R0201,W0613,F0401,W0622
 import urllib, os, uuid, datetime
+from xml.sax.saxutils import escape, quoteattr
 
 from django.core import exceptions
 from django.core.urlresolvers import reverse
+from django.db import close_connection
 from django.views.generic.base import View
 from django.http import (HttpResponse, Http404, HttpResponseBadRequest, 
-                         HttpResponseServerError)
+                         HttpResponseForbidden, HttpResponseServerError)
 from django.shortcuts import get_object_or_404
 from django.contrib.sites.models import Site
 
@@ -17,11 +19,44 @@ try:
 except ImportError:
     import simplejson as json
 
-from models import Account, Container, DirectoryNotEmpty
+from models import (Account, Container, DirectoryNotEmpty, InvalidObjectName, 
+                    NameConflict)
+from storage import get_storage_backend
+from auth import get_token_account_name, forget_token
+from instrumentation import instrumented, instrumented_iter
+from downloads import (get_download_backend, set_object_headers, 
+                       manifest_etag, serve_segments)
 import settings
 from http import (HttpResponseCreated, HttpResponseAccepted, 
                     HttpResponseNoContent, HttpResponseConflict,
-                    HttpResponseUnauthorized)
+                    HttpResponseUnauthorized, HttpResponseServiceUnavailable,
+                    iter_request_body, RequestBodyTruncated,
+                    check_preconditions, parse_object_metadata, 
+                    MAX_METADATA_SIZE)
+
+def get_storage_object_or_404(container, object_name):
+    """
+    Return the storage object ``object_name`` of ``container``, raising 
+    :class:`Http404` for a name that can't name an object
+    """
+    try:
+        return container.get_storage_object(object_name)
+    except InvalidObjectName:
+        raise Http404()
+
+
+def check_writable(container):
+    """
+    Return a 503 (Service Unavailable) response when ``container`` is read 
+    only while its objects are moved, otherwise ``None``
+    """
+    if not container.read_only:
+        return None
+    response = HttpResponseServiceUnavailable(
+        'The container is being moved, try again later')
+    response['Retry-After'] = '60'
+    return response
+
 
 class AuthenticationView(View):
     """
@@ -41,6 +76,7 @@ class AuthenticationView(View):
         try:
             account = Account.objects.get(user__username=username, 
                                           auth_key=authkey)
+            forget_token(account.auth_token)
             account.auth_token = str(uuid.uuid4())
             account.token_expires = datetime.datetime.now() + datetime.timedelta(hours=1)
             account.save()
@@ -56,7 +92,53 @@ class AuthenticationView(View):
         except Account.DoesNotExist:
             return HttpResponseUnauthorized()
 
-class AccountView(View):
+
+def close_connection_after(body):
+    """
+    Yield the pieces of ``body``, a listing that reads the database as it is
+    streamed, then close the database connection. Django closes it when the 
+    view returns, before the body is read, so the queries of the listing 
+    open a new one.
+    """
+    try:
+        for piece in body:
+            yield piece
+    finally:
+        close_connection()
+
+
+class TokenRequiredMixin(object):
+    """
+    Only dispatch requests that carry a valid ``X-Auth-Token`` for the 
+    account in the URL
+    """
+    def dispatch(self, request, account_name, *args, **kwargs):
+        """Check the token before handling the request"""
+        if not self.has_account_token(request, account_name) and \
+                not self.allows_anonymous(request, account_name, *args):
+            return HttpResponseUnauthorized()
+        return super(TokenRequiredMixin, self).dispatch(
+            request, account_name, *args, **kwargs)
+    
+    def has_account_token(self, request, account_name):
+        """
+        Does the request carry a valid token for the account?
+        """
+        token = request.META.get('HTTP_X_AUTH_TOKEN')
+        return get_token_account_name(token) == account_name
+    
+    def allows_anonymous(self, request, account_name, container_name=None, 
+                         *args):
+        """
+        Anyone may read the contents of public containers
+        """
+        if container_name is None or request.method not in ('GET', 'HEAD'):
+            return False
+        return Container.objects.filter(account__user__username=account_name, 
+            name=container_name, is_public=True).exists()
+
+
+class AccountView(TokenRequiredMixin, View):
     """
     Basic handlers against account resources:
     
@@ -78,6 +160,7 @@ class AccountView(View):
                 'content_type': 'text/plain'},
         }
     
+    @instrumented('serialize')
     def xml_serializer(self, account, records):
         """Serialize a set of container records in xml"""
         wrapper = "\n".join([
@@ -87,10 +170,12 @@ class AccountView(View):
         containers = [container_record % r for r in records]
         return wrapper % (account, "".join(containers))
     
+    @instrumented('serialize')
     def json_serializer(self, account, records):
         """Serialize a set of container records in json"""
         return json.dumps(records)
     
+    @instrumented('serialize')
     def default_serializer(self, account, records):
         """A default serializer for unknown formats"""
         return "\n".join([r['name'] for r in records])
@@ -101,7 +186,9 @@ class AccountView(View):
         format = request.GET.get('format', None)
         marker = request.GET.get('marker', None)
         limit = int(request.GET.get('limit', 10000))
-        return self.list_containers(account, False, limit, marker, format)
+        fresh = request.GET.get('fresh', '') in ('1', 'true')
+        return self.list_containers(account, False, limit, marker, format, 
+                                    fresh)
     
     def head(self, request, account_name, *args, **kwargs):
         """Return Account Metadata"""
@@ -109,7 +196,7 @@ class AccountView(View):
         return self.list_containers(account, True)
     
     def list_containers(self, account, metadata_only=False, limit=10000, 
-                        marker=None, format=None):
+                        marker=None, format=None, fresh=False):
         """
         ``GET`` operations against the ``X-Storage-Url`` for an account are 
         performed to retrieve a list of existing storage containers ordered by 
@@ -128,47 +215,61 @@ class AccountView(View):
         format
             Specify either json or xml to return the respective serialized 
             response.
-        """
-        containers = account.container_set.all()
         
+        fresh
+            With ``1``, count the objects and bytes of each listed container 
+            on disk instead of reporting its stored counters. The counters 
+            and name index are left as they are; the ``reconcile_containers``
+            command rebuilds them.
+        """
         if metadata_only:
             response = HttpResponseNoContent()
-            response['X-Account-Container-Count'] = len(containers)
-            total_size = 0
-            for container in containers:
-                total_size += container.total_size
-            response['X-Account-Total-Bytes-Used'] = total_size
+            response['X-Account-Container-Count'] = account.container_count
+            response['X-Account-Object-Count'] = account.object_count
+            response['X-Account-Bytes-Used'] = account.bytes_used
+            response['X-Account-Total-Bytes-Used'] = account.bytes_used
             return response
         
-        if marker is not None:
-            containers = containers.filter(name__gt='marker')
+        containers = account.container_set.all()
         
-        if len(containers) == 0:
-            return HttpResponseNoContent()
+        if marker is not None:
+            containers = containers.filter(name__gt=marker)
+        containers = containers[:limit]
         
         # If no format is specified, we only need the names. So return them 
-        # without doing the extra work of calculating additional info
+        # without doing the extra work of fetching additional info
         if format is None:
-            return HttpResponse(
-                "\n".join([c.name for c in containers]), 
-                content_type="text/plain")
-        else:
+            names = list(containers.values_list('name', flat=True))
+            if not names:
+                return HttpResponseNoContent()
+            return HttpResponse("\n".join(names), content_type="text/plain")
+        
+        if fresh:
             records = []
-            for item in containers:
-                cont_rec = {
-                    'name': item.name,
-                    'count': item.file_count,
-                    'bytes': item.total_size,
-                }
-                records.append(cont_rec)
-            serializer = self.serializers.get(format, self.serializers['default'])
-            
-            return HttpResponse(
-                serializer['function'](account, records),
-                content_type=serializer['content_type'])
+            for container in containers:
+                count, num_bytes = container.backend.usage(container.path)
+                records.append({
+                    'name': container.name,
+                    'count': count,
+                    'bytes': num_bytes,
+                })
+        else:
+            records = [{
+                'name': item['name'],
+                'count': item['object_count'],
+                'bytes': item['bytes_used'],
+            } for item in containers.values('name', 'object_count', 
+                                            'bytes_used')]
+        if not records:
+            return HttpResponseNoContent()
+        serializer = self.serializers.get(format, self.serializers['default'])
+        
+        return HttpResponse(
+            serializer['function'](account, records),
+            content_type=serializer['content_type'])
 
 
-class ContainerView(View):
+class ContainerView(TokenRequiredMixin, View):
     """
     Basic handlers for container requests:
     
@@ -191,11 +292,9 @@ class ContainerView(View):
                 'content_type': 'text/plain'},
         }
     
+    @instrumented_iter('serialize')
     def xml_serializer(self, container, records):
-        """Serialize a set of container records in xml"""
-        wrapper = "".join([
-            '<?xml version="1.0" encoding="UTF-8"?>\n\n',
-            '<container name="%s">%s</container>'])
+        """Serialize container records in xml, piece by piece"""
         container_record = ''.join([
             '<object>',
             '<name>%(name)s</name>',
@@ -203,17 +302,47 @@ class ContainerView(View):
             '<hash>%(hash)s</hash>',
             '<content_type>%(content_type)s</content_type>',
             '<last_modified>%(last_modified)s</last_modified>',
+            '%(metadata)s',
             '</object>'])
-        objs = [container_record % r for r in records]
-        return wrapper % (container.name, "\n".join(objs))
-
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n\n'
+        yield '<container name="%s">' % container.name
+        separator = ''
+        for record in records:
+            record = dict(record, metadata=''.join(
+                '<meta name=%s>%s</meta>' % (quoteattr(name), escape(value))
+                for name, value in sorted(record['metadata'].items())))
+            yield separator + container_record % record
+            separator = '\n'
+        yield '</container>'
+    
+    @instrumented_iter('serialize')
     def json_serializer(self, container, records):
-        """Serialize a set of container records in json"""
-        return json.dumps(records)
+        """Serialize container records in json, piece by piece"""
+        yield '['
+        separator = ''
+        for record in records:
+            yield separator + json.dumps(record)
+            separator = ', '
+        yield ']'
     
+    @instrumented_iter('serialize')
     def default_serializer(self, container, records):
         """A default serializer for unknown formats"""
-        return "\n".join([r['name'] for r in records])
+        separator = ''
+        for record in records:
+            yield separator + record['name']
+            separator = '\n'
+    
+    def object_record(self, item, path=None):
+        """The serializable record for the storage object ``item``"""
+        return {
+            'name': path and item.name or item.full_name,
+            'hash': item.hash,
+            'bytes': item.bytes,
+            'content_type': item.content_type,
+            'last_modified': item.last_modified.isoformat(),
+            'metadata': item.metadata,
+        }
     
     def get(self, request, account_name, container_name, *args, **kwargs):
         """List the objects in the container"""
@@ -247,8 +376,8 @@ class ContainerView(View):
         except exceptions.DoesNotExist:
             raise Http404()
         response = HttpResponseNoContent()
-        response['X-Container-Object-Count'] = container.file_count
-        response['X-Container-Bytes-Used'] = container.total_size
+        response['X-Container-Object-Count'] = container.object_count
+        response['X-Container-Bytes-Used'] = container.bytes_used
         return response
     
     def put(self, request, account_name, container_name, *args, **kwargs):
@@ -276,7 +405,7 @@ class ContainerView(View):
         
         try:
             path = os.path.join(settings.CONTAINER_LOCATION, account_name, container_name)
-            os.makedirs(path)
+            get_storage_backend().create_container(path)
             Container.objects.create(
                 name=container_name, 
                 path=path, 
@@ -302,7 +431,10 @@ class ContainerView(View):
         except Container.DoesNotExist:
             raise Http404()
         
-        if container.file_count:
+        response = check_writable(container)
+        if response is not None:
+            return response
+        if not container.is_empty():
             return HttpResponseConflict('Container not empty')
         
         container.delete()
@@ -347,32 +479,28 @@ class ContainerView(View):
             For a character *c*, return all the object names nested in the 
             container (without the need for the directory marker objects).
         """
-        objs = container.storage_objects(limit, marker, prefix, path, delimiter)
-        
         if format is None:
-            return HttpResponse(
-                "\n".join([path and o.name or o.full_name for o in objs]), 
-                content_type="text/plain")
+            objs = container.iter_storage_objects(limit, marker, prefix, path, 
+                                                  delimiter, stat=False)
+            records = ({'name': path and o.name or o.full_name} for o in objs)
+            body = self.default_serializer(container, records)
+            return HttpResponse(close_connection_after(body), 
+                                content_type="text/plain")
         else:
-            records = []
-            for item in objs:
-                cont_rec = {
-                    'name': path and item.name or item.full_name,
-                    'hash': item.hash,
-                    'bytes': item.bytes,
-                    'content_type': item.content_type,
-                    'last_modified': item.last_modified.isoformat(),
-                }
-                records.append(cont_rec)
+            objs = container.iter_storage_objects(limit, marker, prefix, path, 
+                                                  delimiter)
+            records = (self.object_record(item, path) 
+                       for item in container.with_checksums(objs, 
+                            parallel=True, timeout=settings.CHECKSUM_TIMEOUT))
             serializer = self.serializers.get(format, 
                                               self.serializers['default'])
             
-            return HttpResponse(
-                serializer['function'](container, records),
-                content_type=serializer['content_type'])
+            body = serializer['function'](container, records)
+            return HttpResponse(close_connection_after(body),
+                                content_type=serializer['content_type'])
 
 
-class ObjectView(View):
+class ObjectView(TokenRequiredMixin, View):
     """
     Basic handlers for object requests:
     
@@ -383,39 +511,116 @@ class ObjectView(View):
     def get(self, request, account_name, container_name, object_name, 
             *args, **kwargs):
         """Retrieve an object in the container"""
-        from django.views.static import serve
-        
         account = get_object_or_404(Account, user__username=account_name)
         try:
             container = account.container_set.get(name=container_name)
         except exceptions.DoesNotExist:
             raise Http404()
         
-        return serve(request, object_name, document_root=container.path)
+        s_obj = get_storage_object_or_404(container, object_name)
+        
+        if not s_obj.exists or s_obj.isdir:
+            raise Http404()
+        response = self.check_segments_readable(request, account_name, s_obj)
+        if response is not None:
+            return response
+        
+        etag, segments = self.object_etag(s_obj)
+        response = check_preconditions(request, etag, s_obj.modified)
+        if response is None:
+            if not s_obj.manifest:
+                return get_download_backend().serve(request, s_obj)
+            response = serve_segments(s_obj, segments)
+        set_object_headers(response, s_obj, etag)
+        return response
+    
+    def check_segments_readable(self, request, account_name, s_obj):
+        """
+        Return a 403 (Forbidden) response if ``s_obj`` is a large object the
+        request may read but whose segments it may not: anonymous readers of 
+        a public container only get the segments of public containers.
+        """
+        if not s_obj.manifest or self.has_account_token(request, account_name):
+            return None
+        container = s_obj.segment_container()
+        if container is not None and not container.is_public:
+            return HttpResponseForbidden()
+        return None
+    
+    def object_etag(self, s_obj):
+        """
+        Return the ``ETag`` of ``s_obj`` and, for a large object, its segments
+        """
+        if s_obj.manifest:
+            segments = s_obj.manifest_segments()
+            return manifest_etag(segments), segments
+        return s_obj.hash, None
     
     def put(self, request, account_name, container_name, object_name, 
             *args, **kwargs):
-        """Create/Update object"""
+        """
+        Create/Update object
+        
+        Objects larger than a single upload are uploaded as segments, 
+        ordinary objects whose names share a prefix, in parallel if desired. 
+        A ``PUT`` of the object itself with an ``X-Object-Manifest: 
+        <container>/<prefix>`` header then makes its ``GET`` return the 
+        segments one after the other in name order.
+        """
         account = get_object_or_404(Account, user__username=account_name)
         try:
             container = account.container_set.get(name=container_name)
         except exceptions.DoesNotExist:
             raise Http404()
         
-        sobj = container.get_storage_object(object_name)
+        response = check_writable(container)
+        if response is not None:
+            return response
+        try:
+            sobj = container.get_storage_object(object_name)
+        except InvalidObjectName:
+            return HttpResponseBadRequest('Invalid object name')
+        metadata = parse_object_metadata(request)
+        if metadata is None:
+            return HttpResponseBadRequest(
+                'Object metadata is limited to %d bytes' % MAX_METADATA_SIZE)
         
         if 'HTTP_X_COPY_FROM' in request.META:
-            scontainer_name, s_object_name = request.META['HTTP_COPY_FROM'].lstrip('/').split('/', 1)
+            copy_from = urllib.unquote(request.META['HTTP_X_COPY_FROM'])
+            try:
+                scontainer_name, s_object_name = copy_from.lstrip('/').split('/', 1)
+            except ValueError:
+                return HttpResponseBadRequest('X-Copy-From must be <container>/<object>')
             try:
                 scontainer = account.container_set.get(name=scontainer_name)
-            except exceptions.DoesNotExist:
+            except Container.DoesNotExist:
+                raise Http404()
+            source_sobj = get_storage_object_or_404(scontainer, s_object_name)
+            if not source_sobj.exists or source_sobj.isdir:
                 raise Http404()
-            source_sobj = scontainer.get_storage_object(s_object_name)
             
-            sobj.write(source_sobj.read())
+            try:
+                etag = sobj.copy_from(source_sobj, metadata)
+            except NameConflict:
+                return HttpResponseConflict('Object name conflicts with a directory')
         else:
-            sobj.write(request.raw_post_data)
-        return HttpResponseNoContent()
+            manifest = urllib.unquote(
+                request.META.get('HTTP_X_OBJECT_MANIFEST', '')).lstrip('/')
+            if manifest and '/' not in manifest:
+                return HttpResponseBadRequest('X-Object-Manifest must be <container>/<prefix>')
+            try:
+                etag = sobj.write(
+                    iter_request_body(request, settings.UPLOAD_CHUNK_SIZE), 
+                    manifest, metadata)
+            except RequestBodyTruncated:
+                # The backend discarded what was written; the object is as 
+                # it was
+                return HttpResponseBadRequest('Incomplete request body')
+            except NameConflict:
+                return HttpResponseConflict('Object name conflicts with a directory')
+        response = HttpResponseNoContent()
+        response['ETag'] = etag
+        return response
     
     def delete(self, request, account_name, container_name, object_name, 
             *args, **kwargs):
@@ -435,7 +640,10 @@ class ObjectView(View):
         except Container.DoesNotExist:
             raise Http404()
         
-        s_obj = container.get_storage_object(object_name)
+        response = check_writable(container)
+        if response is not None:
+            return response
+        s_obj = get_storage_object_or_404(container, object_name)
         
         if not s_obj.exists:
             raise Http404()
@@ -458,29 +666,50 @@ class ObjectView(View):
         except exceptions.DoesNotExist:
             raise Http404()
         
-        s_obj = container.get_storage_object(object_name)
+        s_obj = get_storage_object_or_404(container, object_name)
         
         if not s_obj.exists:
             raise Http404()
+        response = self.check_segments_readable(request, account_name, s_obj)
+        if response is not None:
+            return response
         
-        response = HttpResponseNoContent()
-        response['ETag'] = s_obj.hash
-        # TODO: Django overrides this value anyway
-        #response['Content-Length'] = s_obj.bytes
-        response['Content-Type'] = s_obj.content_type
-        
-        timefmt = '%a, %d %b %Y %H:%M:%S %Z'
-        response['Last-Modified'] = s_obj.last_modified.strftime(timefmt)
+        etag, segments = self.object_etag(s_obj)
+        response = check_preconditions(request, etag, s_obj.modified)
+        if response is None:
+            response = HttpResponseNoContent()
+            # TODO: Django overrides this value anyway
+            #response['Content-Length'] = s_obj.bytes
+            response['Content-Type'] = s_obj.content_type
+        set_object_headers(response, s_obj, etag)
         return response
     
-    def post(self, request, account_name, *args, **kwargs):
+    def post(self, request, account_name, container_name, object_name, 
+             *args, **kwargs):
         """
         POST operations against an object name are used to set and overwrite 
         arbitrary key/value metadata. You cannot use the POST operation to 
         change any of the object's other headers such as Content-Type, ETag, 
         etc. It is not used to upload storage objects (see PUT).
         
-        Currently ignored.
+        The ``X-Object-Meta-*`` headers of the request replace all of the 
+        object's metadata.
         """
+        account = get_object_or_404(Account, user__username=account_name)
+        try:
+            container = account.container_set.get(name=container_name)
+        except Container.DoesNotExist:
+            raise Http404()
+        
+        response = check_writable(container)
+        if response is not None:
+            return response
+        s_obj = get_storage_object_or_404(container, object_name)
+        if not s_obj.exists or s_obj.isdir:
+            raise Http404()
+        metadata = parse_object_metadata(request)
+        if metadata is None:
+            return HttpResponseBadRequest(
+                'Object metadata is limited to %d bytes' % MAX_METADATA_SIZE)
+        s_obj.set_metadata(metadata)
         return HttpResponseAccepted()
-    
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+WSGI helpers for deploying rapid
+"""
+import settings
+
+class FileWrapperMiddleware(object):
+    """
+    Wrap the Django WSGI handler so responses from the
+    :class:`rapid.downloads.WSGIFileWrapperBackend` are sent with the
+    server's ``wsgi.file_wrapper``::
+    
+        import django.core.handlers.wsgi
+        from rapid.wsgi import FileWrapperMiddleware
+        
+        application = FileWrapperMiddleware(
+            django.core.handlers.wsgi.WSGIHandler())
+    """
+    def __init__(self, application):
+        self.application = application
+    
+    def __call__(self, environ, start_response):
+        response = self.application(environ, start_response)
+        fileobj = getattr(response, 'file_to_stream', None)
+        if fileobj is None or 'wsgi.file_wrapper' not in environ:
+            return response
+        return environ['wsgi.file_wrapper'](fileobj,
+                                            settings.DOWNLOAD_CHUNK_SIZE)